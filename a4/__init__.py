@@ -3,9 +3,12 @@ __all__ = [ 'die'
           , 'parse_range'
           , 'parse_date'
           , 'parse_date_range'
+          , 'parse_dates'
+          , 'parse_date_ranges'
           , 'parse_url'
           , 'get_opts'
           , 'parse_opts'
+          , 'compile_spec'
           ]
 
 
@@ -15,11 +18,18 @@ if __name__ == '__main__':
 
 import sys
 import os
-import re
-import getopt
-import datetime as dt
-from calendar import monthrange
+from array import array
 from collections.abc import MutableMapping
+from functools import lru_cache
+
+# re, datetime and calendar are imported on first use, so that
+# `import a4` stays cheap for command-line startup
+
+
+@lru_cache(maxsize=None)
+def _re(pattern):
+    import re
+    return re.compile(pattern)
 
 
 def die(msg):
@@ -59,33 +69,36 @@ def parse_range(spec, *, sep='-', comma=','):
     return ret
 
 
+def _date_num(spec, now):
+    dstr = spec.replace('-', '').replace('/', '')
+    if _re(r'^\d{8}$').match(dstr):
+        return int(dstr)
+    mo = _re(r'(yest|tomo)(\d+)?').match(dstr)
+    if mo:
+        if mo.group(1) == 'yest':
+            shift = -int(mo.group(2)) if mo.group(2) else -1
+        else:
+            shift =  int(mo.group(2)) if mo.group(2) else  1
+        import datetime as dt
+        ts = now + dt.timedelta(days = shift)
+        return int(ts.strftime('%Y%m%d'))
+    elif dstr != 'today' and dstr != 'this':
+        raise ValueError(f'inavlid date spec {spec}')
+    return int(now.strftime('%Y%m%d'))
+
+
 def parse_date(spec, *, to_str = False, cal = 0):
     """Accpets:
     yyyy[-]mm[-]dd, this, today, yest[N], tomo[N]
     """
 
-    dnum = None
-    dstr = spec.replace('-', '').replace('/', '')
-    if re.match(r'^\d{8}$', dstr):
-        dnum = int(dstr)
-    else:
-        now = dt.datetime.now()
-        dnum = int(now.strftime('%Y%m%d'))
-        mo = re.match(r'(yest|tomo)(\d+)?', dstr)
-        if mo:
-            if mo.group(1) == 'yest':
-                shift = -int(mo.group(2)) if mo.group(2) else -1
-            else:
-                shift =  int(mo.group(2)) if mo.group(2) else  1
-            ts = dt.datetime.now() + dt.timedelta(days = shift)
-            dnum = int(ts.strftime('%Y%m%d'))
-        elif dstr != 'today' and dstr != 'this':
-            raise ValueError(f'inavlid date spec {spec}')
-
+    import datetime as dt
+    dnum = _date_num(spec, dt.datetime.now())
     return str(dnum) if to_str else dnum
 
 
 def parse_date_range(spec, *, sep='-'):
+    from calendar import monthrange
     beg, end = parse_range(spec, sep=sep, comma=None)
     if int(beg) > int(end):
         raise ValueError('Invalid date range spec')
@@ -105,6 +118,56 @@ def parse_date_range(spec, *, sep='-'):
     return (int(beg), end)
 
 
+def _to_kind(nums, kind):
+    if kind == 'array':
+        return nums
+    import numpy as np
+    ret = np.frombuffer(nums, dtype=np.int32).copy()
+    if kind == 'int':
+        return ret
+    if kind == 'datetime64':
+        y, m, d = ret // 10000, ret // 100 % 100, ret % 100
+        return ((y - 1970).astype('datetime64[Y]') +
+                (m - 1).astype('timedelta64[M]') +
+                (d - 1).astype('timedelta64[D]'))
+    raise ValueError(f'invalid result kind {kind}')
+
+
+def parse_dates(specs, *, kind = 'array'):
+    """Batch parse_date(): parse an iterable of specs into yyyymmdd ints.
+
+    Returns array('i'), or with NumPy a numpy int32 array (kind='int') or
+    datetime64[D] array (kind='datetime64').  "now" is taken once for the
+    whole batch and repeated specs are parsed once.
+    """
+    import datetime as dt
+    now = dt.datetime.now()
+    memo = {}
+    ret = array('i')
+    append = ret.append
+    for spec in specs:
+        dnum = memo.get(spec)
+        if dnum is None:
+            dnum = memo[spec] = _date_num(spec, now)
+        append(dnum)
+    return _to_kind(ret, kind)
+
+
+def parse_date_ranges(specs, *, sep='-', kind = 'array'):
+    """Batch parse_date_range(): returns (begins, ends) arrays, see
+    parse_dates() for `kind`.
+    """
+    memo = {}
+    begs, ends = array('i'), array('i')
+    for spec in specs:
+        rng = memo.get(spec)
+        if rng is None:
+            rng = memo[spec] = parse_date_range(spec, sep=sep)
+        begs.append(rng[0])
+        ends.append(rng[1])
+    return (_to_kind(begs, kind), _to_kind(ends, kind))
+
+
 def parse_url(url, **kw):
     "Parse URL to dict[str, str], tolerate special characters in password"
     ret = {}
@@ -120,7 +183,7 @@ def parse_url(url, **kw):
         else:
             ret['user'] = auth[:j]
             ret['pass'] = auth[j+1:]
-    mo = re.match(r'^([^:/?]+)(:(\d+))?([/?](.+))?$', url)
+    mo = _re(r'^([^:/?]+)(:(\d+))?([/?](.+))?$').match(url)
     if mo is not None:
         host, port, path = (mo.group(1), mo.group(3), mo.group(4))
         ret['host'] = host
@@ -136,7 +199,7 @@ def parse_url(url, **kw):
             if first == '?':
                 params = path.split(',')
             else:
-                pm = re.match(r'^([^?]+)\?(.+)$', path)
+                pm = _re(r'^([^?]+)\?(.+)$').match(path)
                 if pm:
                     path = pm.group(1).strip('/')
                     params = pm.group(2).split(',')
@@ -154,33 +217,196 @@ def parse_url(url, **kw):
     return ret
 
 
+class _OptError(Exception):
+    pass
+
+
+def _argfile(path, chunk = 1 << 16):
+    """Yield arguments of response file `path` ('-' for stdin), one per line
+    or NUL separated if the first chunk has a NUL, reading it by chunks.
+    """
+    f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        sep, tail = None, b''
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            if sep is None:
+                sep = b'\0' if b'\0' in data else b'\n'
+            items = (tail + data).split(sep)
+            tail = items.pop()
+            for item in items:
+                if sep == b'\n':
+                    item = item.rstrip(b'\r')
+                if item:
+                    yield os.fsdecode(item)
+        if tail.rstrip(b'\r'):
+            yield os.fsdecode(tail.rstrip(b'\r'))
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def _expand(argv):
+    "Stream `argv` with @file arguments replaced by the file contents."
+    for arg in argv:
+        if arg[:1] == '@' and len(arg) > 1:
+            yield from _argfile(arg[1:])
+        else:
+            yield arg
+
+
+def _short_has_arg(opt, shortopts):
+    for i in range(len(shortopts)):
+        if opt == shortopts[i] != ':':
+            return shortopts.startswith(':', i + 1)
+    raise _OptError(f'option -{opt} not recognized')
+
+
+def _long_has_arg(opt, longopts):
+    matches = [o for o in longopts if o.startswith(opt)]
+    if not matches:
+        raise _OptError(f'option --{opt} not recognized')
+    if opt in matches:
+        return False, opt
+    if opt + '=' in matches:
+        return True, opt
+    if len(matches) > 1:
+        raise _OptError(f'option --{opt} not a unique prefix')
+    match = matches[0]
+    if match.endswith('='):
+        return True, match[:-1]
+    return False, match
+
+
+def _getopt(argv, shortopts, longopts = (), *, greedy = True):
+    """getopt.gnu_getopt(), or getopt.getopt() unless `greedy`, in a single
+    pass over iterable `argv` instead of slicing it at every option.
+    """
+    if not greedy:
+        posix = True
+    elif shortopts.startswith('+'):
+        shortopts, posix = shortopts[1:], True
+    else:
+        posix = bool(os.environ.get('POSIXLY_CORRECT'))
+    opts, args = [], []
+    it = iter(argv)
+    for arg in it:
+        if arg == '--':
+            args.extend(it)
+            break
+        if arg[:2] == '--':
+            opt, eq, val = arg[2:].partition('=')
+            has_arg, opt = _long_has_arg(opt, longopts)
+            if not has_arg:
+                if eq:
+                    raise _OptError(f'option --{opt} must not have an argument')
+            elif not eq:
+                val = next(it, None)
+                if val is None:
+                    raise _OptError(f'option --{opt} requires argument')
+            opts.append(('--' + opt, val))
+        elif arg[:1] == '-' and arg != '-':
+            for i in range(1, len(arg)):
+                opt = arg[i]
+                if not _short_has_arg(opt, shortopts):
+                    opts.append(('-' + opt, ''))
+                    continue
+                val = arg[i + 1:]
+                if not val:
+                    val = next(it, None)
+                    if val is None:
+                        raise _OptError(f'option -{opt} requires argument')
+                opts.append(('-' + opt, val))
+                break
+        elif posix:
+            args.append(arg)
+            args.extend(it)
+            break
+        else:
+            args.append(arg)
+    return (opts, args)
+
+
+@lru_cache(maxsize=1024)
+def _getopt_defaults(spec):
+    # make sure all switch chars are in opts, use None as False
+    return {k: None if (k + ':') in spec else False
+            for k in spec.replace(':', '')}
+
+
 def get_opts(spec = None, argv = None, **kw):
     panic  = kw.get('panic',  True)
     greedy = kw.get('greedy', True)
+    argfiles = kw.get('argfiles', False)  # expand @file arguments
     if argv is None:
         argv = sys.argv[1:]
+    if argfiles:
+        argv = _expand(argv)
     if not spec:
-        return ({}, argv)
+        return ({}, list(argv))
 
+    o, args = [], []
     try:
-        if greedy:
-            (o, args) = getopt.gnu_getopt(argv, spec)
-        else:
-            (o, args) = getopt.getopt(argv, spec)
-    except getopt.GetoptError as e:
+        (o, args) = _getopt(argv, spec, greedy=greedy)
+    except (_OptError, OSError) as e:
         if panic:
             sys.stderr.write(f'{str(e)}\n')
             sys.exit(2)
 
-    # make sure all switch chars are in opts, use None as False
-    opts = {k: None if (k + ':') in spec else False
-            for k in spec.replace(':', '')}
+    opts = dict(_getopt_defaults(spec))
     for key, val in o:
         opts[key[1:2]] = val or True
 
     return (opts, args)
 
 
+class OptSpec:
+    """parse_opts() spec compiled once: getopt strings, the option names
+    getopt reports mapped to OptDict keys, and the OptDict defaults.
+    """
+    __slots__ = ('text', 's_spec', 'l_spec', 'names', 'defaults')
+
+    def __init__(self, spec):
+        self.text = spec
+        self.s_spec, self.l_spec, odict = parse_cmd_spec(spec)
+        self.names = {}
+        for k in self.s_spec.replace(':', ''):
+            self.names['-' + k] = (k, bool(odict[k]))
+        for k in self.l_spec:
+            k = k.rstrip('=')
+            self.names['--' + k] = (k, bool(odict[k]))
+        self.defaults = {k: None if v else False for k, v in odict.items()}
+
+
+    def parse(self, argv, *, greedy = True, panic = True, argfiles = False):
+        o = {}
+        args = []
+        if argfiles:
+            argv = _expand(argv)
+        try:
+            (o, args) = _getopt(argv, self.s_spec, self.l_spec, greedy=greedy)
+        except (_OptError, OSError) as e:
+            if panic:
+                sys.stderr.write(f'{str(e)}\n')
+                sys.exit(2)
+
+        # the defaults template is the whole of the setup per parse
+        opts = OptDict._from(self.defaults)
+        names = self.names
+        for key, val in o:
+            key, has_val = names[key]
+            opts.__dict__[key] = val if has_val else True
+        return (opts, args)
+
+
+@lru_cache(maxsize=1024)
+def compile_spec(spec):
+    "Compile a parse_opts() spec, cached by its text."
+    return OptSpec(spec)
+
+
 def parse_opts(spec = None, argv = None, **kw):
     panic  = kw.get('panic',  True)
     greedy = kw.get('greedy', True)
@@ -191,21 +417,10 @@ def parse_opts(spec = None, argv = None, **kw):
     if not spec:
         return ({}, argv)
 
-    # parse spec for human to spec for getopt
-    s_spec, l_spec, odict = parse_cmd_spec(spec)
-
-    # parse with standard getopt
-    o = {}
-    args = []
-    try:
-        if greedy:
-            (o, args) = getopt.gnu_getopt(argv, s_spec, l_spec)
-        else:
-            (o, args) = getopt.getopt(argv, s_spec, l_spec)
-    except getopt.GetoptError as e:
-        if panic:
-            sys.stderr.write(f'{str(e)}\n')
-            sys.exit(2)
+    if not isinstance(spec, OptSpec):
+        spec = compile_spec(spec)
+    opts, args = spec.parse(argv, greedy=greedy, panic=panic,
+                            argfiles=kw.get('argfiles', False))
 
     # check args count
     if argc is not None:
@@ -222,15 +437,7 @@ def parse_opts(spec = None, argv = None, **kw):
         else:
             good = True # ignore argc type error
         if not good:
-            die_usage(spec, name = app)
-
-    # fill default values from spec
-    opts = OptDict({k: None if v else False for k, v in odict.items()})
-
-    # fill values from command line
-    for key, val in o:
-        key = key[2:] if key[1] == '-' else key[1:]
-        opts[key] = val if odict[key] else True
+            die_usage(spec.text, name = app)
 
     return (opts, args)
 
@@ -238,6 +445,11 @@ def parse_opts(spec = None, argv = None, **kw):
 class OptDict(MutableMapping):
     def __init__(self, *args, **kwargs):
         self.__dict__.update(*args, **kwargs)
+    @classmethod
+    def _from(cls, template):
+        ret = cls.__new__(cls)
+        ret.__dict__.update(template)
+        return ret
     def __setitem__(self, key, value):
         self.__dict__[key] = value
     # support x['a', 'b']
@@ -274,11 +486,11 @@ def parse_cmd_spec(spec):
             line = line[2:].strip()
         if line and line[0] == ',':
             line = line[1:].strip()
-        mo = re.match(r'^--(\S+)(.*)$', line)
+        mo = _re(r'^--(\S+)(.*)$').match(line)
         if mo:
             l_opt = mo.group(1)
             line = mo.group(2)
-        has_val = re.match('^<.+>', line.strip())
+        has_val = _re('^<.+>').match(line.strip())
         if s_opt:
             o_dict[s_opt] = has_val
             s_spec += s_opt
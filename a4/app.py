@@ -3,76 +3,407 @@
 ################################################################################
 import os
 import sys
-import re
-import traceback
-import inspect
+import time
+import types
 
-from a4 import get_opts
+from a4 import get_opts, compile_spec
 import a4.log as log
+import a4.trace as trace
 
 
 class AppBase:
+    # warm server (-S <socket>): worker processes, requests before recycling
+    _serve_workers = 4
+    _serve_requests = 1000
+    # results of daily.cached commands: directory ($A4_CACHE or
+    # ~/.cache/a4/<app>), evicted by age in seconds and total size in bytes
+    _cache_dir = None
+    _cache_age = 90 * 86400
+    _cache_size = 1 << 30
+    # expand @file arguments, files of arguments one per line or NUL ended
+    _argfiles = False
+    # file appended a record of resources used by each run ($A4_LEDGER),
+    # False for none
+    _ledger = None
+
     def __init__(self, name = None):
         self.name = name
         self.dry = False
         self.debug = False
         self.verbose = False
+        self._jobs = 1
         self.excode = 0
+        self._metrics = None
+        self._cache_store = None
+        self._command = None    # sub-command dispatched
 
 
-    def _log(self, msg):
+    def _log(self, msg, *args):
         if self.verbose:
-            log.info(msg)
+            log.info(msg, *args)
         return self
 
 
-    def _warn(self, msg):
-        log.warn(msg)
+    def _warn(self, msg, *args):
+        log.warn(msg, *args)
         if self.excode < 1:
             self.excode = 1
         return self
 
 
-    def _err(self, msg):
-        log.err(msg)
+    def _err(self, msg, *args):
+        log.err(msg, *args)
         if self.excode < 2:
             self.excode = 2
         return self
 
 
-    def _die_usage(self):
-        frame = inspect.getouterframes(inspect.currentframe(), 2)
-        app = self.name or os.path.basename(frame[1][1])
-        cmd = frame[1][3]
+    def _registry(self):
+        if self._metrics is None:
+            from a4.metrics import Metrics
+            self._metrics = Metrics()
+        return self._metrics
+
+
+    def _cache(self):
+        "Cache of daily.cached command results, see a4.cache."
+        if self._cache_store is None:
+            from a4.cache import Cache
+            root = self._cache_dir or os.environ.get('A4_CACHE') or \
+                os.path.join(os.path.expanduser('~'), '.cache', 'a4',
+                             self.name or os.path.splitext(
+                                 os.path.basename(sys.argv[0]))[0])
+            self._cache_store = Cache(root, max_age=self._cache_age,
+                                     max_size=self._cache_size)
+        return self._cache_store
+
+
+    async def _gather(self, aws, limit = 8):
+        """Await awaitables of iterable `aws`, at most `limit` at a time, and
+        return their results in order.  The first error cancels the rest.
+        """
+        import asyncio
+        items = enumerate(aws)
+        results = {}
+        async def worker():
+            for i, aw in items:
+                results[i] = await aw
+        tasks = [asyncio.ensure_future(worker()) for _ in range(limit)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            for i, aw in items:
+                if hasattr(aw, 'close'):
+                    aw.close()  # never awaited
+            raise
+        return [results[i] for i in range(len(results))]
+
+
+    # with self._span('load'): ..., or @AppBase._span('load') on methods
+    _span = staticmethod(trace.span)
+
+
+    def _counter(self, name):
+        "Counter `name`, see a4.metrics."
+        return self._registry().counter(name)
+
+
+    def _gauge(self, name):
+        "Gauge `name`, see a4.metrics."
+        return self._registry().gauge(name)
+
+
+    def _histogram(self, name, bounds = None):
+        "Histogram `name` with `bounds` (latencies by default), see a4.metrics."
+        if bounds is None:
+            return self._registry().histogram(name)
+        return self._registry().histogram(name, bounds)
+
+
+    def _die_usage(self, cmd = None):
+        code = sys._getframe(1).f_code
+        # the caller may be a helper, or a lazy function named otherwise
+        cmd = cmd or self._command
+        app = self.name or os.path.basename(sys.argv[0] if cmd else
+                                            code.co_filename)
+        cmd = cmd or code.co_name
         line = getattr(self, cmd).__doc__.split('\n')[0]
         print(f'Usage: {app} {cmd} {line}')
         sys.exit(2)
 
 
+class lazy:
+    # Sub-command implemented elsewhere, as `func(app, args)` in the module
+    # of `target` ('pkg.mod:func', or 'pkg.mod' for a function named as the
+    # command), imported on first call:
+    #
+    #     heavy = lazy('myapp.heavy', """<file>
+    #     Crunch numbers with heavy dependencies.
+    #     """)
+    #
+    # Give `doc` to keep help from importing the module.
+
+    def __init__(self, target, doc = None):
+        self.target = target
+        self.doc = doc
+        self.func = None
+        self.name = None
+
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+
+    def _load(self):
+        if self.func is None:
+            import importlib
+            mod, _, func = self.target.partition(':')
+            self.func = getattr(importlib.import_module(mod),
+                                func or self.name)
+        return self.func
+
+
+    @property
+    def __doc__(self):
+        return self.doc if self.doc is not None else self._load().__doc__
+
+
+    def __call__(self, app, args):
+        return self._load()(app, args)
+
+
+    def __get__(self, obj, cls = None):
+        return self if obj is None else types.MethodType(self, obj)
+
+
+# global options of Runnable apps
+GLOBAL_SPEC = 'nvVj:P:M:T:S:C:'
+
+
+class daily:
+    # Day-parallel sub-command `func(app, day, args)`, called for every day
+    # of the first argument, a comma separated list of parse_date_range()
+    # specs, with the remaining arguments:
+    #
+    #     @daily
+    #     def load(self, day, args):
+    #         """<yyyymmdd[-mmdd]> [args ...]
+    #         Load data of days.
+    #         """
+    #
+    # With -j N, days are handed out to N forked workers, each running
+    # `_init` and `_cleanup` itself and inheriting -n/-v/-V; the exit code
+    # is the worst of the workers'.  `func` may not be async.
+    #
+    # With @daily.cached, or @daily.cached(key=func(app, args)) when only
+    # some arguments matter, what `func` returns is kept in the app cache
+    # by command, day and key (the arguments by default): days cached are
+    # skipped, and -n only tells which days would be computed.
+
+    def __init__(self, func, *, cache = False, key = None):
+        self.func = func
+        self.cache = cache
+        self.key = key
+        self.__doc__ = func.__doc__
+        self.name = func.__name__
+
+
+    @classmethod
+    def cached(cls, func = None, *, key = None):
+        if func is None:
+            return lambda func: cls(func, cache=True, key=key)
+        return cls(func, cache=True, key=key)
+
+
+    def __call__(self, app, args):
+        if len(args) < 1:
+            app._die_usage(self.name)
+        from a4.rangeset import RangeSet
+        days = list(RangeSet.parse(args[0], dates=True))
+        func = self.func
+        if self.cache:
+            cache = app._cache()
+            key = args[1:] if self.key is None else self.key(app, args[1:])
+            todo = cache.missing(self.name, days, key)
+            spans = RangeSet(((d, d) for d in todo), dates=True)
+            if app.dry:
+                log.note('%s: would compute %d of %d days: %s', self.name,
+                         len(todo), len(days), _spans(spans))
+                return
+            app._log('%s: %d of %d days cached', self.name,
+                     len(days) - len(todo), len(days))
+            days = todo
+            def func(app, day, args):
+                cache.put(self.name, day, key, self.func(app, day, args))
+        try:
+            if app._jobs > 1:
+                _fan_out(app, func, days, args[1:])
+            else:
+                for day in days:
+                    func(app, day, args[1:])
+        finally:
+            if self.cache:
+                cache.evict()
+
+
+    def __get__(self, obj, cls = None):
+        return self if obj is None else types.MethodType(self, obj)
+
+
+def _spans(ranges):
+    return ','.join(str(b) if b == e else f'{b}-{e}'
+                    for b, e in ranges.intervals()) or '-'
+
+
+def _flush():
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+def _fan_out(app, func, days, args):
+    import multiprocessing
+    nxt = multiprocessing.get_context('fork').Value('l', 0)
+    workers = []
+    _flush()
+    for _ in range(min(app._jobs, len(days))):
+        # workers send their metrics back through a pipe when done
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            code = _day_worker(app, func, days, args, nxt)
+            with os.fdopen(w, 'wb') as f:
+                if app._metrics:
+                    import marshal
+                    f.write(marshal.dumps(app._metrics.state()))
+            os._exit(code)
+        os.close(w)
+        workers.append((pid, r))
+    for pid, r in workers:
+        with os.fdopen(r, 'rb') as f:
+            state = f.read()
+        if state:
+            import marshal
+            app._registry().merge(marshal.loads(state))
+        code = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+        app.excode = max(app.excode, code if code >= 0 else 2)
+
+
+def _settle(ret):
+    "Run `ret` of an async hook to completion."
+    if hasattr(ret, '__await__'):
+        import asyncio
+        return asyncio.run(ret)
+    return ret
+
+
+def _day_worker(app, func, days, args, nxt):
+    "Run `func` on days taken from shared index `nxt`, return the exit code."
+    app.excode = 0
+    if app._metrics:
+        app._metrics.reset()
+    try:
+        if hasattr(app, '_init'):
+            _settle(app._init())
+        try:
+            while True:
+                with nxt.get_lock():
+                    i = nxt.value
+                    nxt.value += 1
+                if i >= len(days):
+                    break
+                func(app, days[i], args)
+        finally:
+            if hasattr(app, '_cleanup'):
+                _settle(app._cleanup())
+            if 'a4.pool' in sys.modules:
+                sys.modules['a4.pool'].close_all()
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        app.excode = 2
+    finally:
+        log.flush()
+        _flush()
+    return app.excode
+
+
+# flag of the code of async def functions, as inspect.CO_COROUTINE
+_CO_COROUTINE = 0x80
+
+
+def _is_async(func):
+    "Tell whether `func` is an async def, or a lazy command of one."
+    func = getattr(func, '__func__', func)
+    if isinstance(func, lazy):
+        func = func._load()
+    code = getattr(func, '__code__', None)
+    return code is not None and bool(code.co_flags & _CO_COROUTINE)
+
+
+async def _call(prof, name, func, *args):
+    """Call `func` and await what it returns if awaitable, as span and phase
+    `name` of Profiler `prof` if any.
+    """
+    with trace.span(name):
+        if prof is None:
+            ret = func(*args)
+            return (await ret) if hasattr(ret, '__await__') else ret
+        with prof.phase(name):
+            ret = func(*args)
+            return (await ret) if hasattr(ret, '__await__') else ret
+
+
+def _drive(coro):
+    "Run coroutine `coro` that never suspends, without an event loop."
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError('async code outside of an event loop')
+
+
+def _index(UserApp):
+    "Public sub-commands and all callables of UserApp, in one walk."
+    names = [f for f in dir(UserApp) if callable(getattr(UserApp, f))]
+    return (sorted(f for f in names if not f.startswith('_')), set(names))
+
+
+def _summary(doc):
+    "One-line description of a sub-command from its docstring."
+    if doc is None:
+        return '<no documentation>'
+    lines = doc.split('\n')
+    return lines[1].strip() if len(lines) > 1 else doc
+
+
 def Runnable(UserApp):
     "Turn a class into command line tool with sub-commands."
 
     class App:
+        index = None    # (cmds, allcmds), built once per app class
+        loop = None     # event loop kept by a warm app with async hooks
+
         def __init__(self, **kw):
             self.app = UserApp(**kw)
-            self.cmds = sorted([f for f in dir(UserApp) if
-                                callable(getattr(UserApp, f)) and
-                                not re.match(r'^_', f)])
-            self.allcmds = set([f for f in dir(UserApp) if
-                                callable(getattr(UserApp, f))])
-            self.doc_format = '%%%ds --- %%s' % max(map(len, self.cmds))
+            if App.index is None:
+                App.index = _index(UserApp)
+            self.cmds, self.allcmds = App.index
+
+
+        @property
+        def doc_format(self):
+            return '%%%ds --- %%s' % max(map(len, self.cmds))
 
 
         def getdoc(self, cmd, full=False):
             doc = getattr(UserApp, cmd).__doc__
             if full:
                 return doc is None and '<no documentation>' or doc.strip()
-            if doc is None:
-                doc = '<no documentation>'
-            lines = doc.split('\n')
-            if len(lines) > 1:
-                doc = lines[1].strip()
-            return self.doc_format % (cmd, doc)
+            return self.doc_format % (cmd, _summary(doc))
 
 
         def _print_global_usage(self):
@@ -87,14 +418,50 @@ def Runnable(UserApp):
             usage += ('\n       -n   dry run, change nothing'
                       '\n       -v   be verbose'
                       '\n       -V   turn on debug messages, implies -v'
+                      '\n       -j N run day-parallel commands in N processes'
+                      '\n       -P <mode>    profile the command, <mode> is one of'
+                      '\n                    cpu[:N], cpu:<file>.pstats, mem[:N],'
+                      ' sample[:ms]'
+                      '\n       -M <file>    write metrics as JSON to <file>,'
+                      ' instead of logging them'
+                      '\n       -T <file>    write spans as Chrome trace events'
+                      ' to <file>'
+                      '\n       -S <socket>  serve commands warm on a Unix socket'
+                      '\n       -C <socket>  run the command in the app serving'
+                      ' on <socket>'
                       '\n\n       help <command> --- print help for command'
+                      '\n       help --bash|--zsh [name] --- print a completion'
+                      ' script'
                       '\n\n       ')
             usage += '\n       '.join(map(self.getdoc, self.cmds))
             print(usage, file=sys.stderr)
 
 
         def run(self):
-            (opts, args) = get_opts('nvV', greedy=False)
+            (opts, args) = get_opts(GLOBAL_SPEC, greedy=False,
+                                    argfiles=self.app._argfiles)
+            if opts['C']:
+                from a4.client import call
+                flags = ['-' + k for k in 'nvV' if opts[k]]
+                for k in 'jPMT':
+                    if opts[k]:
+                        flags += ['-' + k, opts[k]]
+                try:
+                    code = call(opts['C'], flags + args)
+                except OSError as e:
+                    print(f"{opts['C']}: {e}", file=sys.stderr)
+                    code = 2
+                sys.exit(code)
+            if opts['S']:
+                from a4.server import serve
+                sys.exit(serve(self, opts['S'],
+                               workers=self.app._serve_workers,
+                               requests=self.app._serve_requests))
+            self.dispatch(opts, args)
+
+
+        def dispatch(self, opts, args, warm = False):
+            "Run the command in `args`; a `warm` app is initialized already."
             if len(args) < 1:
                 self._print_global_usage()
                 sys.exit(0)
@@ -102,6 +469,19 @@ def Runnable(UserApp):
             self.app.dry = opts['n']
             self.app.debug = opts['V']
             self.app.verbose = self.app.debug or opts['v']
+            try:
+                self.app._jobs = int(opts['j'] or 1)
+            except ValueError:
+                print("Bad number of jobs '%s'" % opts['j'], file=sys.stderr)
+                sys.exit(2)
+            prof = None
+            if opts['P']:
+                from a4.prof import Profiler
+                try:
+                    prof = Profiler(opts['P'])
+                except ValueError:
+                    print("Bad profile mode '%s'" % opts['P'], file=sys.stderr)
+                    sys.exit(2)
             if self.app.debug:
                 log.level('d')
 
@@ -110,6 +490,10 @@ def Runnable(UserApp):
                     self._print_global_usage()
                     sys.exit(0)
                 cmd = args[1]
+                if cmd in ('--bash', '--zsh', '--index'):
+                    from a4.complete import main
+                    main(self, args[1:])
+                    sys.exit(0)
                 if cmd not in self.cmds:
                     print("Unkown command '%s'" % cmd, file=sys.stderr)
                 else:
@@ -123,23 +507,109 @@ def Runnable(UserApp):
                 print("Unkown command '%s'" % cmd, file=sys.stderr)
                 sys.exit(2)
             else:
-                if '_init' in self.allcmds:
-                    self.app._init()
-                tback = None
-                try:
-                    getattr(self.app, cmd)(args[1:])
-                except Exception as e:
-                    tback = traceback.format_exc()
-                finally:
-                    if '_finally' in self.allcmds:
-                        self.app._finally()
-                    if '_cleanup' in self.allcmds:
-                        self.app._cleanup()
-                    if tback is None:
-                        sys.exit(self.app.excode)
-                    else:
-                        print(tback, file=sys.stderr)
-                        sys.exit(2)
+                self.app._command = cmd
+                # workers of a day-parallel command initialize themselves
+                if self.app._jobs > 1 and \
+                   isinstance(getattr(UserApp, cmd), daily):
+                    warm = True
+                hooks = [cmd, '_finally']
+                if not warm:
+                    hooks += ['_init', '_cleanup']
+                self._complete(self._steps(opts, args, warm, prof),
+                               self._has_async(hooks))
+
+
+        async def _steps(self, opts, args, warm, prof):
+            # on an event loop if anything is async, else driven by _drive()
+            cmd = args[0]
+            ledger = self.app._ledger
+            if ledger is None:
+                ledger = os.environ.get('A4_LEDGER')
+            if not isinstance(ledger, (str, os.PathLike)):
+                ledger = None   # False, or not a path
+            if ledger:
+                from a4.ledger import Usage
+                usage = Usage()
+            if opts['T']:
+                trace.start()
+            if not warm and '_init' in self.allcmds:
+                await _call(prof, '_init', self.app._init)
+            tback = None
+            start = time.time()
+            try:
+                func = getattr(self.app, cmd)
+                # the docstring doubles as a parse_opts() spec
+                if func.__doc__:
+                    compile_spec(func.__doc__)
+                await _call(prof, cmd, func, args[1:])
+            except Exception as e:
+                import traceback
+                tback = traceback.format_exc()
+            finally:
+                if '_finally' in self.allcmds:
+                    await _call(None, '_finally', self.app._finally)
+                if not warm and '_cleanup' in self.allcmds:
+                    await _call(prof, '_cleanup', self.app._cleanup)
+                if not warm and 'a4.pool' in sys.modules:
+                    sys.modules['a4.pool'].close_all()
+                if opts['T']:
+                    trace.stop(opts['T'])
+                if self.app._metrics:
+                    code = 2 if tback else self.app.excode
+                    self.app._metrics.report(opts['M'], command=cmd,
+                                            args=args[1:], start=start,
+                                            wall=time.time() - start,
+                                            excode=code)
+                    self.app._metrics.reset()
+                if ledger:
+                    self._record(ledger, usage, args,
+                                 2 if tback else self.app.excode)
+                log.flush()
+                if tback is None:
+                    sys.exit(self.app.excode)
+                else:
+                    print(tback, file=sys.stderr)
+                    sys.exit(2)
+
+
+        def _record(self, path, usage, args, code):
+            from a4.ledger import append
+            app = self.app.name or os.path.basename(sys.argv[0])
+            rec = usage.record(app=app, cmd=args[0],
+                               args=' '.join(args[1:])[:200], code=code)
+            try:
+                append(path, rec)
+            except OSError as e:
+                log.warn('ledger %s: %s', path, e)
+
+
+        def _has_async(self, names):
+            return any(_is_async(getattr(UserApp, f)) for f in names
+                       if f in self.allcmds)
+
+
+        def _complete(self, coro, is_async):
+            "Run `coro` on the event loop if `is_async`, logging off it."
+            if not is_async:
+                return _drive(coro)
+            quiet = log._queue is None
+            if quiet:
+                log.background()
+            try:
+                if self.loop is not None:
+                    return self.loop.run_until_complete(coro)
+                import asyncio
+                return asyncio.run(coro)
+            finally:
+                if quiet:
+                    log.stop()
+
+
+        def hook(self, name):
+            "Call hook `name`, such as '_init', if the app has it."
+            if name in self.allcmds:
+                self._complete(_call(None, name, getattr(self.app, name)),
+                               self._has_async([name]))
     return App
 
 ### a4/app.py ends here
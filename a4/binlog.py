@@ -0,0 +1,288 @@
+################################################################################
+# a4.binlog --- binary log sink on a memory mapped ring buffer
+################################################################################
+"""Records are written as (format id, level, timestamp, packed arguments)
+into fixed size slots of a ring buffer in a memory mapped file; formatting is
+left to the decoder:
+
+    python3 -m a4.binlog decode [-n N] <file>
+
+The file lives in the page cache, so the last records survive a crash of the
+writing process.  Layout:
+
+    header | string table | slot 0 | slot 1 | ... | slot N-1
+
+The string table holds every format string seen, a slot holds one record
+with its arguments in marshal format.  Processes sharing the file, such as
+forked children, take sequence numbers in blocks from a counter in the
+header and add format strings under a lock of the file.
+"""
+__all__ = ['Sink', 'read']
+
+import os
+import sys
+import mmap
+import fcntl
+import struct
+import marshal
+import threading
+import itertools
+import time
+from contextlib import contextmanager
+
+import a4.log as log
+from a4 import get_opts
+from a4.app import AppBase, Runnable
+
+
+MAGIC = b'A4BLOG01'
+RAW   = 0xffffffff  # format id of pre-rendered messages
+
+# magic, slot size, slots, string table size, string table used, strings
+_HEAD = struct.Struct('<8sIIIII')
+_HEAD_SIZE = 64
+# offset in the header of the next sequence number free for any process
+_NEXT = 32
+# sequence numbers taken from the header at a time, 1 << _BITS
+_BITS  = 8
+_BLOCK = 1 << _BITS
+# seq + 1 (0 marks an empty slot), timestamp ns, format id, level, size
+_SLOT = struct.Struct('<QQIBxH')
+_SEQ  = struct.Struct('<Q')
+_STR  = struct.Struct('<H')
+
+
+class Sink:
+    """Binary log file of `slots` records of `slot_size` bytes each.
+
+    An existing file of the same geometry is appended to, its string table
+    reused.  Messages without arguments, and records whose arguments do not
+    fit in a slot or cannot be marshalled, are stored rendered and truncated.
+    """
+
+    def __init__(self, path, *, slots = 65536, slot_size = 128,
+                 strtab = 1 << 20):
+        if slot_size <= _SLOT.size or slot_size > 0xffff:
+            raise ValueError(f'invalid slot size {slot_size}')
+        self.path = path
+        self.slot_size = slot_size
+        self.slots = slots
+        self.strtab = strtab
+        self.size = _HEAD_SIZE + strtab + slots * slot_size
+        self.ids = {}
+
+        # kept open for the lock shared with other processes
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked():
+            fresh = os.fstat(self.fd).st_size != self.size
+            if fresh:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+            self.mm = mmap.mmap(self.fd, self.size)
+
+            head = _HEAD.unpack_from(self.mm, 0)
+            if fresh or head[:4] != (MAGIC, slot_size, slots, strtab):
+                self.mm[:_HEAD_SIZE + strtab] = bytes(_HEAD_SIZE + strtab)
+                self.used, seq = 0, 0
+                self._sync_head()
+            else:
+                self.used = head[4]
+                strings = _strings(self.mm, head)
+                self.ids = {s: i for i, s in enumerate(strings)}
+                seq = max([_SEQ.unpack_from(self.mm, _NEXT)[0]] +
+                          [s for s, _ in _slots(self.mm, head)])
+            _SEQ.pack_into(self.mm, _NEXT, seq)
+
+        self.ring = _HEAD_SIZE + strtab
+        self.room = slot_size - _SLOT.size
+        self._after_fork()
+
+
+    def _after_fork(self):
+        "Take blocks of sequence numbers afresh, as in a forked child."
+        self.lock = threading.Lock()
+        self.tickets = itertools.count().__next__
+        self.blocks = {}    # ticket >> _BITS: first sequence number
+
+
+    @contextmanager
+    def _locked(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+
+    def _reserve(self, block):
+        with self.lock:
+            base = self.blocks.get(block)
+            if base is None:
+                with self._locked():
+                    base = _SEQ.unpack_from(self.mm, _NEXT)[0]
+                    _SEQ.pack_into(self.mm, _NEXT, base + _BLOCK)
+                self.blocks[block] = base
+                self.blocks.pop(block - 2, None)
+        return base
+
+
+    def _sync_head(self):
+        _HEAD.pack_into(self.mm, 0, MAGIC, self.slot_size, self.slots,
+                        self.strtab, self.used, len(self.ids))
+
+
+    def _intern(self, fmt):
+        with self._locked():
+            head = _HEAD.unpack_from(self.mm, 0)
+            if head[5] != len(self.ids):
+                # added by other processes
+                self.used = head[4]
+                strings = _strings(self.mm, head)
+                self.ids = {s: i for i, s in enumerate(strings)}
+                if fmt in self.ids:
+                    return self.ids[fmt]
+            data = fmt.encode('utf-8', 'replace')
+            need = _STR.size + len(data)
+            if len(data) > 0xffff or self.used + need > self.strtab:
+                return RAW
+            pos = _HEAD_SIZE + self.used
+            self.mm[pos+_STR.size:pos+need] = data
+            _STR.pack_into(self.mm, pos, len(data))
+            self.used += need
+            self.ids[fmt] = fid = len(self.ids)
+            self._sync_head()
+            return fid
+
+
+    def record(self, level, msg, args = (), ts = None):
+        if ts is None:
+            ts = time.time_ns()
+        if callable(msg):
+            msg, args = msg(), ()
+        # only format strings are worth a place in the string table, not
+        # one-off messages such as f-strings
+        fid = self.ids.get(msg) if args and isinstance(msg, str) else RAW
+        if fid is None:
+            with self.lock:
+                fid = self.ids.get(msg)
+                if fid is None:
+                    fid = self._intern(msg)
+        data = None
+        if fid != RAW:
+            try:
+                data = marshal.dumps(args, 4)
+            except ValueError:
+                pass
+        if data is None or len(data) > self.room:
+            text = (msg % args if args else str(msg)).encode('utf-8', 'replace')
+            text = text[:self.room-5].decode('utf-8', 'ignore')
+            fid, data = RAW, marshal.dumps(text, 4)
+        # seq from an atomic counter within a block of this process, so
+        # threads and processes never share a slot; the slot is filled by
+        # one memcpy, its seq field marks it committed
+        t = self.tickets()
+        base = self.blocks.get(t >> _BITS)
+        if base is None:
+            base = self._reserve(t >> _BITS)
+        seq = base + (t & _BLOCK - 1)
+        pos = self.ring + (seq % self.slots) * self.slot_size
+        self.mm[pos:pos+_SLOT.size+len(data)] = (
+            _SLOT.pack(seq + 1, ts, fid, level, len(data)) + data)
+
+
+    def flush(self):
+        self.mm.flush()
+
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+            os.close(self.fd)
+
+
+def _strings(buf, head):
+    strings = []
+    pos = _HEAD_SIZE
+    for _ in range(head[5]):
+        n = _STR.unpack_from(buf, pos)[0]
+        strings.append(bytes(buf[pos+2:pos+2+n]).decode('utf-8', 'replace'))
+        pos += 2 + n
+    return strings
+
+
+def _slots(buf, head):
+    "Yield (seq, offset) of every committed slot."
+    _, slot_size, slots, strtab = head[:4]
+    ring = _HEAD_SIZE + strtab
+    for i in range(slots):
+        pos = ring + i * slot_size
+        seq = _SEQ.unpack_from(buf, pos)[0]
+        if seq and (seq - 1) % slots == i:
+            yield seq, pos
+
+
+def read(path, last = None):
+    "Yield (timestamp ns, level, message) of records in `path`, oldest first."
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _HEAD_SIZE:
+            raise ValueError(f'{path}: not a binary log')
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    head = _HEAD.unpack_from(buf, 0)
+    if head[0] != MAGIC or len(buf) < _HEAD_SIZE + head[3] + head[1] * head[2]:
+        raise ValueError(f'{path}: not a binary log')
+    strings = _strings(buf, head)
+    # by time, as processes take sequence numbers in blocks
+    slots = sorted(_slots(buf, head),
+                   key=lambda s: (_SLOT.unpack_from(buf, s[1])[1], s[0]))
+    if last is not None:
+        slots = slots[-last:] if last > 0 else []
+    for _, pos in slots:
+        _, ts, fid, level, size = _SLOT.unpack_from(buf, pos)
+        try:
+            args = marshal.loads(buf[pos+_SLOT.size:pos+_SLOT.size+size])
+        except (EOFError, ValueError, TypeError):
+            args = ('<corrupt record>',)
+            fid = RAW
+        if fid == RAW:
+            msg = args if isinstance(args, str) else args[0]
+        elif fid >= len(strings):
+            msg = f'<unknown format {fid}> {args!r}'
+        else:
+            fmt = strings[fid]
+            try:
+                msg = fmt % args if args else fmt
+            except (TypeError, ValueError):
+                msg = f'{fmt} {args!r}'
+        yield ts, level, msg
+
+
+@Runnable
+class BinlogApp(AppBase):
+    def __init__(self):
+        AppBase.__init__(self, 'a4.binlog')
+
+
+    def decode(self, args):
+        """[-n N] <file>
+        Print binary log records as text.
+        -n  <N>   only the last N records
+        """
+        opts, args = get_opts('n:', args)
+        if len(args) != 1:
+            self._die_usage()
+        last = int(opts['n']) if opts['n'] else None
+        out = sys.stdout
+        try:
+            for ts, level, msg in read(args[0], last):
+                tag = log._TAGS.get(level, ('????', 0))[0]
+                out.write(f'[{log._ts(ts / 1e9)}] {tag} {msg}\n')
+        except (OSError, ValueError) as e:
+            self._err(str(e))
+
+
+if __name__ == '__main__':
+    BinlogApp().run()
+
+### a4/binlog.py ends here
@@ -0,0 +1,113 @@
+################################################################################
+# a4.cache --- per-day results of commands on disk
+################################################################################
+__all__ = ['Cache']
+
+import os
+import time
+import pickle
+import hashlib
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Cache:
+    """Results of commands by day under `root`, as
+    <root>/<cmd>/<key hash>/<yyyymmdd>.pkl, where `key` stands for the
+    options the results depend on.
+
+    Entries older than `max_age` seconds count as missing; evict() removes
+    them, then the oldest entries until all take at most `max_size` bytes.
+    """
+
+    def __init__(self, root, *, max_age = None, max_size = None):
+        self.root = root
+        self.max_age = max_age
+        self.max_size = max_size
+
+
+    def _path(self, cmd, day, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.root, cmd, digest, f'{day}.pkl')
+
+
+    def _fresh(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        return self.max_age is None or time.time() - mtime <= self.max_age
+
+
+    def missing(self, cmd, days, key):
+        "Days of `days` without a fresh entry."
+        return [day for day in days
+                if not self._fresh(self._path(cmd, day, key))]
+
+
+    def get(self, cmd, day, key, default = None):
+        path = self._path(cmd, day, key)
+        if not self._fresh(path):
+            return default
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+    def put(self, cmd, day, key, value):
+        "Store `value` atomically."
+        path = self._path(cmd, day, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+
+    def invalidate(self, cmd, days = None):
+        "Remove entries of `cmd`, of `days` only if given, for any key."
+        names = None if days is None else {f'{day}.pkl' for day in days}
+        for path, _, _ in self._entries(os.path.join(self.root, cmd)):
+            if names is None or os.path.basename(path) in names:
+                _remove(path)
+
+
+    def _entries(self, top):
+        "(path, mtime, size) of all entries under `top`."
+        for base, _, files in os.walk(top):
+            for name in files:
+                if name.endswith('.pkl'):
+                    path = os.path.join(base, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, st.st_mtime, st.st_size
+
+
+    def evict(self):
+        "Remove expired entries, then the oldest beyond max_size."
+        if self.max_age is None and self.max_size is None:
+            return
+        horizon = None if self.max_age is None else time.time() - self.max_age
+        kept, total = [], 0
+        for path, mtime, size in self._entries(self.root):
+            if horizon is not None and mtime < horizon:
+                _remove(path)
+            else:
+                kept.append((mtime, size, path))
+                total += size
+        if self.max_size is None or total <= self.max_size:
+            return
+        kept.sort()
+        for mtime, size, path in kept:
+            _remove(path)
+            total -= size
+            if total <= self.max_size:
+                break
+
+### a4/cache.py ends here
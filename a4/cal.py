@@ -0,0 +1,160 @@
+################################################################################
+# a4.cal --- business day calendar on a sorted array of yyyymmdd ints
+################################################################################
+__all__ = ['Calendar']
+
+import os
+import mmap
+import struct
+import datetime as dt
+from array import array
+from bisect import bisect_left, bisect_right
+
+from a4 import parse_range, parse_date_range
+
+
+MAGIC = b'A4CAL001'
+_HEAD = struct.Struct('<8sq')
+
+
+def _date(num):
+    return dt.date(num // 10000, num // 100 % 100, num % 100)
+
+
+def _num(date):
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def _days(beg, end):
+    "Yield dates from yyyymmdd `beg` to `end`, inclusive."
+    one = dt.timedelta(days = 1)
+    date, last = _date(beg), _date(end)
+    while date <= last:
+        yield date
+        date += one
+
+
+class Calendar:
+    """Sorted business days as yyyymmdd ints.
+
+    `days` is any sorted sequence of ints: an array('i') when built, a
+    read-only view of a memory mapped file when loaded, so that processes
+    loading the same file share it.  Lookups are binary searches.
+    """
+
+    def __init__(self, days = ()):
+        self.days = days if isinstance(days, (array, memoryview)) else \
+            array('i', days)
+
+
+    @classmethod
+    def build(cls, years, holidays = (), *, weekend = (5, 6)):
+        """Calendar of `years` (a parse_date_range spec such as '2024' or
+        '2020-24') without weekends and `holidays`.  A holiday is a
+        parse_date_range spec, or mmdd[-mmdd] to exclude in every year; an
+        mmdd-mmdd range may wrap around the year end, as '1230-0102'.
+        """
+        beg, end = parse_date_range(str(years))
+        spans = []
+        for spec in map(str, holidays):
+            if len(spec.split('-')[0]) == 4:
+                hb, he = map(int, parse_range(spec, comma=None))
+                ranges = [(hb, he)] if hb <= he else [(hb, 1231), (101, he)]
+                spans.extend((y * 10000 + b, y * 10000 + e) for b, e in ranges
+                             for y in range(beg // 10000, end // 10000 + 1))
+            else:
+                spans.append(parse_date_range(spec))
+        days = array('i')
+        for date in _days(beg, end):
+            num = _num(date)
+            if date.weekday() not in weekend and \
+               not any(hb <= num <= he for hb, he in spans):
+                days.append(num)
+        return cls(days)
+
+
+    def __len__(self):
+        return len(self.days)
+
+
+    def __iter__(self):
+        return iter(self.days)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return type(self)(self.days[i])
+        return self.days[i]
+
+
+    def __contains__(self, day):
+        return self.is_business_day(day)
+
+
+    def __repr__(self):
+        if not self.days:
+            return 'Calendar()'
+        return f'Calendar({self.days[0]}-{self.days[-1]}, {len(self)} days)'
+
+
+    def _at(self, i):
+        if i < 0 or i >= len(self.days):
+            raise IndexError('date out of calendar')
+        return self.days[i]
+
+
+    def is_business_day(self, day):
+        i = bisect_left(self.days, day)
+        return i < len(self.days) and self.days[i] == day
+
+
+    def next(self, day):
+        "First business day after `day`."
+        return self._at(bisect_right(self.days, day))
+
+
+    def prev(self, day):
+        "Last business day before `day`."
+        return self._at(bisect_left(self.days, day) - 1)
+
+
+    def shift(self, day, n):
+        """The `n`th business day after (n > 0) or before (n < 0) `day`;
+        shift(day, 0) is `day` if a business day, else the next one.
+        """
+        if n > 0:
+            return self._at(bisect_right(self.days, day) + n - 1)
+        return self._at(bisect_left(self.days, day) + n)
+
+
+    def count(self, beg, end):
+        "Number of business days from `beg` to `end`, inclusive."
+        return max(0, bisect_right(self.days, end) - bisect_left(self.days, beg))
+
+
+    def range(self, beg, end):
+        "Calendar of business days from `beg` to `end`, inclusive."
+        return type(self)(self.days[bisect_left(self.days, beg):
+                                  bisect_right(self.days, end)])
+
+
+    def save(self, path):
+        "Write to `path` atomically, for load()."
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEAD.pack(MAGIC, len(self.days)))
+            f.write(array('i', self.days).tobytes())
+        os.replace(tmp, path)
+
+
+    @classmethod
+    def load(cls, path):
+        "Map a file written by save(), shared with other processes."
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n = _HEAD.unpack_from(mm, 0)
+        if magic != MAGIC or len(mm) != _HEAD.size + 4 * n:
+            raise ValueError(f'{path}: not a calendar file')
+        return cls(memoryview(mm)[_HEAD.size:].cast('i'))
+
+### a4/cal.py ends here
@@ -0,0 +1,55 @@
+################################################################################
+# a4.client --- thin client of a Runnable app serving on a Unix socket
+################################################################################
+"""Run a sub-command in a warm app started with `-S <socket>`:
+
+    python3 -m a4.client <socket> [options] <cmd> [args ...]
+
+Only socket support is imported, the app itself is not.  stdin, stdout and
+stderr are handed to the server as file descriptors, so output streams
+straight to them; the exit code is the command's.
+"""
+__all__ = ['call']
+
+import os
+import sys
+import socket
+import struct
+
+
+def call(path, argv, *, cwd = None):
+    "Run `argv` in the app serving on `path`, return the exit code."
+    # the working directory and arguments, NUL separated
+    req = '\0'.join([cwd or os.getcwd(), *argv]).encode('utf-8',
+                                                         'surrogateescape')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        for stream in (sys.stdout, sys.stderr):
+            stream.flush()
+        socket.send_fds(sock, [struct.pack('!I', len(req))], [0, 1, 2])
+        sock.sendall(req)
+        buf = b''
+        while len(buf) < 4:
+            data = sock.recv(4 - len(buf))
+            if not data:
+                raise ConnectionError(f'{path}: server closed connection')
+            buf += data
+    return struct.unpack('!i', buf)[0]
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.stderr.write('Usage: python3 -m a4.client <socket> [args ...]\n')
+        sys.exit(2)
+    try:
+        code = call(sys.argv[1], sys.argv[2:])
+    except OSError as e:
+        sys.stderr.write(f'{sys.argv[1]}: {e}\n')
+        code = 2
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
+
+### a4/client.py ends here
@@ -0,0 +1,166 @@
+################################################################################
+# a4.complete --- shell completion of Runnable apps from a static index
+################################################################################
+"""`<app> help --bash [name]` and `<app> help --zsh [name]` print a
+completion script for the command `name`, by default the name the app was
+run as, and write the index it answers from, one line per sub-command:
+
+    <cmd> TAB <options> TAB <one-line doc>
+
+The script reads the index with shell builtins, never starting Python, and
+has `<app> help --index <file>` rewrite it when the module of the app is
+newer than the index.
+"""
+__all__ = ['index', 'write_index', 'script']
+
+import os
+import sys
+import shlex
+
+from a4 import parse_cmd_spec
+from a4.app import GLOBAL_SPEC, _summary
+
+
+def _options(spec):
+    "Short and long option names of get_opts() `spec`."
+    s_spec, l_spec = spec[:2]
+    return ([f'-{c}' for c in s_spec if c != ':'] +
+            [f'--{name.rstrip("=")}' for name in l_spec])
+
+
+def index(app):
+    "Index lines of the sub-commands of Runnable `app`."
+    UserApp = type(app.app)
+    lines = []
+    for cmd in app.cmds:
+        doc = getattr(UserApp, cmd).__doc__
+        opts = _options(parse_cmd_spec(doc)) if doc else []
+        summary = ' '.join(_summary(doc).split())
+        lines.append(f'{cmd}\t{" ".join(opts)}\t{summary}\n')
+    return ''.join(lines)
+
+
+def write_index(app, path):
+    "Write the index of `app` to `path` atomically."
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(index(app))
+    os.replace(tmp, path)
+
+
+_BASH = '''\
+# bash completion of {prog}, from `{prog} help --bash`
+_a4_{fn}() {{
+    local index={index}
+    if [[ ! -e $index || {module} -nt $index ]]; then
+        (cd {cwd} && {regen}) >/dev/null 2>&1
+    fi
+    local cur=${{COMP_WORDS[COMP_CWORD]}} i word cmd= name opts doc words=
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        word=${{COMP_WORDS[i]}}
+        case $word in
+            {with_arg}) ((i++)) ;;
+            -*) ;;
+            *) cmd=$word; break ;;
+        esac
+    done
+    if [[ -z $cmd && $cur == -* ]]; then
+        words="{global_opts}"
+    elif [[ -z $cmd || $cmd == help ]]; then
+        while IFS=$'\\t' read -r name opts doc; do
+            words+=" $name"
+        done < "$index"
+        [[ -z $cmd ]] && words+=" help"
+    elif [[ $cur == -* ]]; then
+        while IFS=$'\\t' read -r name opts doc; do
+            [[ $name == "$cmd" ]] && words=$opts && break
+        done < "$index"
+    else
+        return 1
+    fi
+    COMPREPLY=($(compgen -W "$words" -- "$cur"))
+}}
+complete -o default -F _a4_{fn} {prog}
+'''
+
+_ZSH = '''\
+#compdef {prog}
+# zsh completion of {prog}, from `{prog} help --zsh`
+_a4_{fn}() {{
+    local index={index}
+    if [[ ! -e $index || {module} -nt $index ]]; then
+        (cd {cwd} && {regen}) >/dev/null 2>&1
+    fi
+    local i word cmd= name opts doc
+    local -a cmds
+    for ((i = 2; i < CURRENT; i++)); do
+        word=${{words[i]}}
+        case $word in
+            ({with_arg}) ((i++)) ;;
+            (-*) ;;
+            (*) cmd=$word; break ;;
+        esac
+    done
+    if [[ -z $cmd && $PREFIX == -* ]]; then
+        compadd -- {global_opts}
+    elif [[ -z $cmd || $cmd == help ]]; then
+        while IFS=$'\\t' read -r name opts doc; do
+            cmds+=("$name:$doc")
+        done < $index
+        [[ -z $cmd ]] && cmds+=('help:print help for command')
+        _describe command cmds
+    elif [[ $PREFIX == -* ]]; then
+        while IFS=$'\\t' read -r name opts doc; do
+            [[ $name == $cmd ]] && compadd -- ${{=opts}} && break
+        done < $index
+    else
+        _files
+    fi
+}}
+if [[ $zsh_eval_context[-1] == loadautofunc ]]; then
+    _a4_{fn} "$@"
+else
+    compdef _a4_{fn} {prog}
+fi
+'''
+
+
+def script(app, shell, prog, path):
+    """Completion script of `app` run as `prog` for `shell`, 'bash' or 'zsh',
+    answering from index `path`.
+    """
+    module = getattr(sys.modules.get(type(app.app).__module__), '__file__',
+                     None) or ''
+    # the interpreter arguments that ran the app, as `-m pkg.app` or a script
+    start = len(sys.orig_argv) - len(sys.argv) + 1
+    regen = shlex.join([sys.executable] + sys.orig_argv[1:start] +
+                       ['help', '--index', path])
+    if os.environ.get('PYTHONPATH'):
+        regen = f'PYTHONPATH={shlex.quote(os.environ["PYTHONPATH"])} {regen}'
+    with_arg = '|'.join(f'-{c}' for i, c in enumerate(GLOBAL_SPEC)
+                        if GLOBAL_SPEC[i+1:i+2] == ':')
+    global_opts = ' '.join(f'-{c}' for c in GLOBAL_SPEC if c != ':')
+    return (_BASH if shell == 'bash' else _ZSH).format(
+        prog=prog, fn=''.join(c if c.isalnum() else '_' for c in prog),
+        index=shlex.quote(path), module=shlex.quote(os.path.abspath(module))
+        if module else "''", cwd=shlex.quote(os.getcwd()),
+        regen=regen, with_arg=with_arg, global_opts=global_opts)
+
+
+def main(app, args):
+    "help --bash|--zsh [name], help --index <file>"
+    if args[0] == '--index':
+        if len(args) != 2:
+            print('Usage: help --index <file>', file=sys.stderr)
+            sys.exit(2)
+        write_index(app, args[1])
+        return
+    prog = args[1] if len(args) > 1 else os.path.basename(sys.argv[0])
+    cache = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(cache, 'a4', 'complete', f'{prog}.idx')
+    write_index(app, path)
+    sys.stdout.write(script(app, args[0][2:], prog, path))
+
+### a4/complete.py ends here
@@ -0,0 +1,174 @@
+################################################################################
+# a4.inputs --- streaming input of file arguments
+################################################################################
+"""Commands taking input files read them as a stream of lines:
+
+    def load(self, args):
+        for line in lines(args):
+            ...
+
+`-` stands for stdin; gzip, bzip2 and xz input, told by its first bytes, is
+decompressed a chunk at a time; regular files are memory mapped.  Lines are
+split a chunk at a time, and up to `ahead` inputs are read by threads ahead
+of the consumer, so decompression and page faults overlap the processing.
+"""
+__all__ = ['chunks', 'lines']
+
+import os
+import sys
+import stat
+import mmap
+import threading
+from queue import Queue, Full
+from contextlib import nullcontext
+from itertools import chain
+
+CHUNK = 1 << 16
+
+_MAGIC = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'lzma'))
+
+
+def _decompressor(head):
+    for magic, name in _MAGIC:
+        if head.startswith(magic):
+            return __import__(name)
+    return None
+
+
+def _read(f, size):
+    read = f.read
+    while True:
+        buf = read(size)
+        if not buf:
+            return
+        yield buf
+
+
+def _mapped(fd, size, sep):
+    "Chunks of the file mapped from `fd`, ending with `sep` where possible."
+    mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        pos, n = 0, len(mm)
+        while pos < n:
+            end = pos + size
+            if end < n:
+                i = mm.rfind(sep, pos, end)
+                if i >= 0:
+                    end = i + len(sep)
+            yield mm[pos:end]
+            pos = end
+    finally:
+        mm.close()
+
+
+def chunks(arg, size = CHUNK, sep = b'\n'):
+    """Chunks of about `size` bytes of input `arg`, a path or '-' for stdin,
+    decompressed; chunks of mapped files end with `sep` where possible.
+    """
+    stdin = arg == '-'
+    with nullcontext(sys.stdin.buffer) if stdin else open(arg, 'rb') as f:
+        mod = _decompressor(f.peek(6)[:6] if hasattr(f, 'peek') else b'')
+        if mod is not None:
+            with mod.open(f, 'rb') as z:
+                yield from _read(z, size)
+            return
+        st = os.fstat(f.fileno())
+        # files of /proc and /sys may have data while reporting size 0
+        if stdin or not stat.S_ISREG(st.st_mode) or not st.st_size:
+            yield from _read(f, size)
+        else:
+            yield from _mapped(f.fileno(), size, sep)
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _fill(arg, q, stop, size, sep):
+    try:
+        for chunk in chunks(arg, size, sep):
+            if not _put(q, chunk, stop):
+                return
+        end = None
+    except BaseException as e:
+        end = e
+    _put(q, end, stop)
+
+
+def _drain(q):
+    while True:
+        item = q.get()
+        if isinstance(item, bytes):
+            yield item
+        elif item is None:
+            return
+        else:
+            raise item
+
+
+def _inputs(args, ahead, size, sep):
+    "Chunk iterators of `args` in order, `ahead` of them filled by threads."
+    if ahead < 1:
+        for arg in args:
+            yield chunks(arg, size, sep)
+        return
+    stop = threading.Event()
+    started = []
+    def start(i):
+        q = Queue(16)
+        threading.Thread(target=_fill, args=(args[i], q, stop, size, sep),
+                         name=f'a4.inputs {args[i]}', daemon=True).start()
+        started.append(q)
+    try:
+        for i in range(min(ahead, len(args))):
+            start(i)
+        for i in range(len(args)):
+            yield _drain(started[i])
+            if i + ahead < len(args):
+                start(i + ahead)
+    finally:
+        stop.set()
+
+
+def _split(args, ahead, size, sep, encoding, errors):
+    "Lists of the lines of each chunk."
+    text = sep.decode(encoding) if encoding else None
+    for it in _inputs(args, ahead, size, sep):
+        tail = []
+        for chunk in it:
+            i = chunk.rfind(sep)
+            if i < 0:
+                tail.append(chunk)
+                continue
+            block = chunk[:i]
+            if tail:
+                tail.append(block)
+                block = b''.join(tail)
+            tail = [chunk[i+len(sep):]]
+            if text is None:
+                yield block.split(sep)
+            else:
+                yield block.decode(encoding, errors).split(text)
+        last = b''.join(tail)
+        if last:
+            yield [last if text is None else last.decode(encoding, errors)]
+
+
+def lines(args, *, ahead = 2, size = CHUNK, sep = b'\n', encoding = None,
+          errors = 'strict'):
+    """Iterator of the lines of inputs `args`, paths or '-' for stdin,
+    without `sep`; bytes, or str if `encoding` is given.  See chunks() for
+    `size`.  Reading stops when the iterator is dropped.
+    """
+    return chain.from_iterable(_split(list(args), ahead, size, sep,
+                                      encoding, errors))
+
+### a4/inputs.py ends here
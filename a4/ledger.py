@@ -0,0 +1,194 @@
+################################################################################
+# a4.ledger --- resources used by each run of Runnable commands
+################################################################################
+"""Runnable apps append one JSON line per run to the ledger file named by
+their `_ledger` attribute or $A4_LEDGER:
+
+    {"t": start, "app": name, "cmd": command, "args": arguments,
+     "wall": seconds, "cpu": seconds, "rss": peak KiB,
+     "io": [read, written, disk read, disk written] bytes, "code": exit code}
+
+CPU time and peak RSS include waited for children, such as -j workers.  The
+ledger is summarized by
+
+    python3 -m a4.ledger summary [-f <file>] [cmd ...]
+    python3 -m a4.ledger check [-f <file>] [-t <ratio>] [-a] [cmd ...]
+"""
+__all__ = ['Usage', 'append', 'read']
+
+import os
+import sys
+import json
+import time
+
+from a4 import get_opts
+from a4.app import AppBase, Runnable
+
+
+def _io():
+    "(rchar, wchar, read_bytes, write_bytes) of this process, or zeros."
+    ret = dict.fromkeys(('rchar', 'wchar', 'read_bytes', 'write_bytes'), 0)
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, _, val = line.partition(':')
+                if key in ret:
+                    ret[key] = int(val)
+    except OSError:
+        pass
+    return list(ret.values())
+
+
+def _cpu():
+    "CPU seconds and peak RSS KiB of this process and waited for children."
+    import resource
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rss = max(me.ru_maxrss, kids.ru_maxrss)
+    if sys.platform == 'darwin':
+        rss //= 1024    # bytes there
+    return (me.ru_utime + me.ru_stime + kids.ru_utime + kids.ru_stime, rss)
+
+
+class Usage:
+    "Resources used from creation to record()."
+
+    def __init__(self):
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        self.cpu0 = _cpu()[0]
+        self.io0 = _io()
+
+
+    def record(self, **fields):
+        "Ledger record of the usage so far, with `fields`."
+        cpu, rss = _cpu()
+        return dict({'t': round(self.start, 3)}, **fields,
+                    wall=round(time.perf_counter() - self.t0, 6),
+                    cpu=round(cpu - self.cpu0, 6), rss=rss,
+                    io=[b - a for a, b in zip(self.io0, _io())])
+
+
+def append(path, record):
+    "Append `record` to ledger `path` in one write, safe for concurrent runs."
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def read(path):
+    "Yield records of ledger `path`, skipping damaged lines."
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                pass
+
+
+def _quantile(values, q):
+    "Nearest rank quantile `q` of sorted `values`."
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _median(values):
+    return _quantile(sorted(values), 0.5)
+
+
+def _runs(path, cmds):
+    "Records of ledger `path` by '<app> <cmd>', of commands `cmds` if any."
+    runs = {}
+    for rec in read(path):
+        if not cmds or rec.get('cmd') in cmds:
+            runs.setdefault(f'{rec.get("app")} {rec.get("cmd")}',
+                            []).append(rec)
+    return runs
+
+
+def _regressions(rec, history, threshold):
+    "Metrics of `rec` beyond `threshold` over the median and p95 of `history`."
+    worse = []
+    for key in ('wall', 'cpu', 'rss'):
+        past = sorted(r[key] for r in history)
+        base = _median(past)
+        if rec[key] > base * (1 + threshold) and \
+           rec[key] > _quantile(past, 0.95):
+            worse.append(f'{key} {rec[key]:g} vs median {base:g}')
+    return worse
+
+
+@Runnable
+class LedgerApp(AppBase):
+    _ledger = False     # runs of this app are not recorded
+
+    def __init__(self):
+        AppBase.__init__(self, 'a4.ledger')
+
+
+    def _path(self, opts):
+        path = opts['f'] or os.environ.get('A4_LEDGER')
+        if not path:
+            self._err('no ledger, give -f <file> or set A4_LEDGER')
+        return path
+
+
+    def summary(self, args):
+        """[-f <file>] [cmd ...]
+        Time, CPU and memory of runs by command.
+        -f  <file>   ledger file, default $A4_LEDGER
+        """
+        opts, args = get_opts('f:', args)
+        path = self._path(opts)
+        if not path:
+            return
+        print(f'{"command":28s} {"runs":>5s} {"fail":>4s}'
+              f' {"wall p50":>9s} {"p95":>8s} {"cpu p50":>8s} {"p95":>8s}'
+              f' {"MiB p50":>8s} {"max":>8s} {"trend":>6s}')
+        for name, recs in sorted(_runs(path, args).items()):
+            wall = sorted(r['wall'] for r in recs)
+            cpu = sorted(r['cpu'] for r in recs)
+            rss = [r['rss'] / 1024 for r in recs]
+            # memory of the last runs against those before
+            old, new = rss[:-5], rss[-5:]
+            trend = f'{100 * (_median(new) / _median(old) - 1):+5.0f}%' \
+                if old else ''
+            fails = sum(1 for r in recs if r.get('code'))
+            print(f'{name:28s} {len(recs):5d} {fails:4d}'
+                  f' {_quantile(wall, 0.5):9.2f} {_quantile(wall, 0.95):8.2f}'
+                  f' {_quantile(cpu, 0.5):8.2f} {_quantile(cpu, 0.95):8.2f}'
+                  f' {_median(rss):8.1f} {max(rss):8.1f} {trend:>6s}')
+
+
+    def check(self, args):
+        """[-f <file>] [-t <ratio>] [-m <N>] [-a] [cmd ...]
+        Flag runs slower or bigger than the runs before them.
+        -f  <file>   ledger file, default $A4_LEDGER
+        -t  <ratio>  tolerance over the median, default 0.25
+        -m  <N>      runs needed for a baseline, default 5
+        -a           check every run, not only the last of each command
+        """
+        opts, args = get_opts('f:t:m:a', args)
+        path = self._path(opts)
+        if not path:
+            return
+        threshold = float(opts['t'] or 0.25)
+        least = int(opts['m'] or 5)
+        for name, recs in sorted(_runs(path, args).items()):
+            first = least if opts['a'] else max(least, len(recs) - 1)
+            for i in range(first, len(recs)):
+                worse = _regressions(recs[i], recs[max(0, i - 100):i],
+                                     threshold)
+                if worse:
+                    when = time.strftime('%Y-%m-%d %H:%M:%S',
+                                         time.localtime(recs[i]['t']))
+                    self._warn('%s at %s: %s', name, when, ', '.join(worse))
+
+
+if __name__ == '__main__':
+    LedgerApp().run()
+
+### a4/ledger.py ends here
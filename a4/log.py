@@ -1,11 +1,19 @@
 ################################################################################
 # a4.log --- minimal logging with timestamp and automatic coloring
 ################################################################################
-__all__ = ['level', 'dbg', 'info', 'note', 'warn', 'err']
+__all__ = ['level', 'enabled', 'dbg', 'info', 'note', 'warn', 'err',
+           'background', 'binary', 'aggregate', 'limit', 'to_file', 'flush',
+           'stop']
 
 import os
 import sys
-import datetime as dt
+import atexit
+import threading
+import time
+import types
+
+# imported on first use, to keep `import a4.log` cheap
+queue = None
 
 ERROR = 1
 WARN  = 2
@@ -17,74 +25,607 @@ fork  = False
 _level = INFO if os.environ.get('DBG', '0') == '0' else DEBUG
 _pipe = not sys.stdout.isatty()
 
+# level: (tag, color)
+_TAGS = {ERROR: ('ERR ', 31),
+         WARN:  ('WARN', 33),
+         NOTE:  ('NOTE', 32),
+         INFO:  ('INFO',  0),
+         DEBUG: ('DBG ', 37)}
+
+# background writer state, see background()
+_queue   = None
+_thread  = None
+_policy  = 'block'
+_batch   = 1024
+_dropped = 0
+_dlock   = threading.Lock()
+
+# a4.binlog.Sink when logging in binary, see binary()
+_sink = None
+
+# _Collector of forked workers' records, see aggregate()
+_collector = None
+
+# a4.logfile.Sink replacing stdout/stderr, see to_file()
+_file = None
+
+# _Limiter of rates and repeats, see limit()
+_limiter = None
+
+# level: (head, mid, tail) of text lines, and the text writer, see _build()
+_affix = {}
+_write = None
+
+# (second, 'yyyy-mm-dd HH:MM:SS.', millisecond, formatted timestamp)
+_ts_cache = (None, '', None, '')
+
 def _color(color: int = 0):
-    if not fork and _pipe:
+    if _file is not None or (not fork and _pipe):
         return ''
     return f'\033[1;{color}m' if color else '\033[0m'
 
 
-def _ts():
-    return str(dt.datetime.now())[:-3]
-
-
-def level(level = None):
-    global _level
+def _ts(t = None):
+    global _ts_cache
+    ms = int((time.time() if t is None else t) * 1000)
+    sec, head, last, ts = _ts_cache
+    if ms == last:
+        return ts
+    if ms // 1000 != sec:
+        sec = ms // 1000
+        head = time.strftime('%Y-%m-%d %H:%M:%S.', time.localtime(sec))
+    ts = f'{head}{ms % 1000:03d}'
+    _ts_cache = (sec, head, ms, ts)
+    return ts
 
-    if level is None:
-        return _level
 
+def _parse(level):
     if isinstance(level, str):
         first = level[0].lower()
         if   first == 'e':
-            _level = ERROR
+            level = ERROR
         elif first == 'w':
-            _level = WARN
+            level = WARN
         elif first == 'i':
-            _level = INFO
+            level = INFO
         elif first == 'n':
-            _level = NOTE
+            level = NOTE
         elif first == 'd':
-            _level = DEBUG
+            level = DEBUG
         else:
-            _level = 0
-    else:
-        _level = level
+            level = 0
+
+    if level < ERROR:
+        level = ERROR
+    elif level > DEBUG:
+        level = DEBUG
 
-    if _level < ERROR:
-        _level = ERROR
-    elif _level > DEBUG:
-        _level = DEBUG
+    return level
 
+
+def level(level = None):
+    global _level
+
+    if level is None:
+        return _level
+
+    _level = _parse(level)
+    _build()
     return _level
 
 
-def err(msg):
-    if _level >= ERROR:
-        print(f'{_color(31)}[{_ts()}] ERR  {msg}{_color()}\n', end='',
-              file=sys.stderr if fork else sys.stdout)
+def enabled(level):
+    "Tell whether records of `level` are emitted, to guard expensive code."
+    return _parse(level) <= _level
+
+
+def _noop(msg, *args):
+    pass
+
+
+def _compile(lvl):
+    "Build the emitter of one level with everything but the message prebaked."
+    if lvl > _level:
+        return _noop
+    emit = _emitter(lvl)
+    if _limiter is not None:
+        emit = _limiter.wrap(lvl, emit)
+    return emit
+
+
+def _emitter(lvl):
+    if _sink is not None:
+        record = _sink.record
+        def emit(msg, *args):
+            record(lvl, msg, args)
+        return emit
+    if _collector is not None:
+        return _collector.emitter(lvl)
+    head, mid, tail = _affix[lvl]
+    write = _write
+    ts = _ts
+    def emit(msg, *args):
+        if args:
+            msg = msg % args
+        elif callable(msg):
+            msg = msg()
+        write(f'{head}{ts()}{mid}{msg}{tail}')
+    return emit
+
+
+def _build():
+    global _err, _warn, _note, _info, _dbg, _write
+    if _queue is not None:
+        _write = _put
+    elif _file is not None:
+        _write = _file.write
+    elif fork:
+        _write = _write_err
+    else:
+        _write = _write_out
+    if _limiter is not None:
+        _limiter.inner.clear()
+    for lvl, (tag, color) in _TAGS.items():
+        _affix[lvl] = (f'{_color(color) if color else ""}[', f'] {tag} ',
+                       f'{_color()}\n')
+    _err, _warn, _note, _info, _dbg = [_compile(lvl) for lvl in
+                                       (ERROR, WARN, NOTE, INFO, DEBUG)]
+
+
+# stable entry points, safe to import by name, calling the emitters of the
+# moment
+def err(msg, *args):
+    _err(msg, *args)
+
+
+def warn(msg, *args):
+    _warn(msg, *args)
+
+
+def note(msg, *args):
+    _note(msg, *args)
+
+
+def info(msg, *args):
+    _info(msg, *args)
+
+
+def dbg(msg, *args):
+    _dbg(msg, *args)
+
+
+# resolve sys.stdout/stderr per call so that redirection keeps working
+def _write_out(line):
+    sys.stdout.write(line)
+
+
+def _write_err(line):
+    sys.stderr.write(line)
+
+
+def _put(line):
+    global _dropped
+    stream = _file if _file is not None else sys.stderr if fork else sys.stdout
+    if _queue is None:
+        stream.write(line)
+    elif _policy == 'block':
+        _queue.put((stream, line))
+    else:
+        try:
+            _queue.put_nowait((stream, line))
+        except queue.Full:
+            if _policy == 'count':
+                with _dlock:
+                    _dropped += 1
+
+
+def _drain(q, batch):
+    while True:
+        items = [q.get()]
+        while len(items) < batch:
+            try:
+                items.append(q.get_nowait())
+            except queue.Empty:
+                break
+        done = False
+        try:
+            # join consecutive lines for the same stream into one write
+            stream, buf, used = None, [], []
+            for item in items:
+                if item is None:
+                    done = True
+                    continue
+                if item[0] is not stream:
+                    if buf:
+                        stream.write(''.join(buf))
+                    stream, buf = item[0], []
+                    if stream not in used:
+                        used.append(stream)
+                buf.append(item[1])
+            if buf:
+                stream.write(''.join(buf))
+            # leave the buffering of a log file alone
+            for stream in used:
+                if stream is not _file:
+                    stream.flush()
+        except Exception:
+            pass
+        finally:
+            for _ in items:
+                q.task_done()
+        if done:
+            return
+
+
+def _start(maxsize):
+    global _queue, _thread, queue
+    import queue
+    _queue = queue.Queue(maxsize)
+    _thread = threading.Thread(target=_drain, args=(_queue, _batch),
+                               name='a4.log', daemon=True)
+    _thread.start()
+
+
+def background(maxsize = 65536, *, policy = 'block', batch = 1024):
+    """Write log records from a background thread.
+
+    Records are put on a bounded queue of `maxsize` entries and written in
+    batches of up to `batch` lines.  `policy` decides what happens when the
+    queue is full: 'block' waits for room, 'drop' discards the record, and
+    'count' discards it and reports the number of lost records on flush().
+    Queued records are flushed at exit.
+    """
+    global _policy, _batch
+    if policy not in ('block', 'drop', 'count'):
+        raise ValueError(f'invalid queue policy {policy}')
+    stop()
+    _policy, _batch = policy, batch
+    _start(maxsize)
+    _build()
+
+
+def binary(path, **kw):
+    """Record logs into binary file `path` instead of writing text.
+
+    Formatting is deferred to `python3 -m a4.binlog decode <path>`, see
+    a4.binlog.Sink for `kw`.  binary(None) goes back to text.
+    """
+    global _sink
+    if _sink is not None:
+        _sink.close()
+        _sink = None
+    if path is not None:
+        from a4.binlog import Sink
+        _sink = Sink(path, **kw)
+    _build()
+
+
+class _Collector:
+    """Single writer for records of this process and its forked children.
+
+    Children send (time, pid, level, format, args) through a pipe, the
+    writer thread keeps records in a heap and writes those older than
+    `window` seconds, so lines are time ordered within the window.
+    """
+
+    def __init__(self, window):
+        import collections
+        import multiprocessing
+        self.window = window
+        self.pid = os.getpid()
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        self.wlock = multiprocessing.Lock()
+        self.local = collections.deque()
+        self.heap = []
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='a4.log.collect',
+                                       daemon=True)
+        self.thread.start()
+
+
+    def emitter(self, lvl):
+        if os.getpid() == self.pid:
+            append = self.local.append
+            pid = self.pid
+            def emit(msg, *args):
+                if args:
+                    msg = msg % args
+                elif callable(msg):
+                    msg = msg()
+                append((time.time(), pid, lvl, msg, ()))
+            return emit
+
+        import pickle
+        send, lock = self.writer.send_bytes, self.wlock
+        def emit(msg, *args):
+            if callable(msg):
+                msg, args = msg(), ()
+            rec = (time.time(), os.getpid(), lvl, msg, args)
+            try:
+                data = pickle.dumps(rec, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                data = pickle.dumps(rec[:3] + (msg % args, ()))
+            # a whole record per locked send, so lines never tear
+            with lock:
+                send(data)
+        return emit
+
+
+    def drain(self, horizon):
+        "Collect pending records and write those stamped before `horizon`."
+        import heapq
+        import pickle
+        with self.lock:
+            recs = []
+            while self.reader.poll(0):
+                recs.append(pickle.loads(self.reader.recv_bytes()))
+            while self.local:
+                recs.append(self.local.popleft())
+            for rec in recs:
+                self.seq += 1
+                heapq.heappush(self.heap, (rec[0], self.seq, rec))
+            lines = []
+            while self.heap and self.heap[0][0] <= horizon:
+                ts, _, (_, pid, lvl, msg, args) = heapq.heappop(self.heap)
+                if args:
+                    try:
+                        msg = msg % args
+                    except Exception:
+                        msg = f'{msg} {args!r}'
+                head, mid, tail = _affix[lvl]
+                lines.append(f'{head}{_ts(ts)}{mid}[{pid}] {msg}{tail}')
+            if lines:
+                _write(''.join(lines))
+
+
+    def run(self):
+        while not self.done.is_set():
+            self.reader.poll(self.window / 2)
+            self.drain(time.time() - self.window)
+
+
+    def close(self):
+        if os.getpid() != self.pid:
+            return
+        self.done.set()
+        self.thread.join()
+        self.drain(float('inf'))
+        self.reader.close()
+        self.writer.close()
+
+
+class _Limiter:
+    """Token bucket per message template (or call site), plus collapsing of
+    identical consecutive records into 'last message repeated N times'.
+
+    Buckets are [tokens, last update, suppressed] lists updated in place.
+    """
+
+    def __init__(self, rate, burst, site, collapse):
+        self.rate = rate
+        self.burst = burst
+        self.site = site
+        self.collapse = collapse
+        self.buckets = {}
+        self.last = None    # (level, msg, args) of the last record written
+        self.repeat = 0
+        self.inner = {}
+        self.lock = threading.Lock()
+
+
+    def wrap(self, lvl, inner):
+        self.inner[lvl] = inner
+        allow = self.allow
+        def emit(msg, *args):
+            if allow(lvl, msg, args):
+                inner(msg, *args)
+        return emit
+
+
+    def allow(self, lvl, msg, args):
+        if self.site:
+            frame = sys._getframe(3)    # past emit() and err()...dbg()
+            # the caller of AppBase._warn() and the like
+            while frame.f_back and frame.f_globals.get('__name__') == 'a4.app':
+                frame = frame.f_back
+            key = (frame.f_code, frame.f_lineno)
+        elif isinstance(msg, str):
+            key = msg
+        else:
+            key = getattr(msg, '__code__', None) or type(msg)
+        repeated = None
+        with self.lock:
+            last = self.last
+            if (self.collapse and last is not None and last[0] == lvl
+                    and last[1] == msg and last[2] == args):
+                self.repeat += 1
+                return False
+            now = time.monotonic()
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            bucket[0] = tokens if tokens < self.burst else self.burst
+            bucket[1] = now
+            ok = bucket[0] >= 1
+            if not ok:
+                # not written, so neither the last message nor its repeats
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if self.collapse:
+                if self.repeat:
+                    repeated = (last[0], self.repeat)
+                self.last, self.repeat = (lvl, msg, args), 0
+        if repeated:
+            self.inner[repeated[0]]('last message repeated %d times',
+                                    repeated[1])
+        return True
+
+
+    def summary(self):
+        "Write pending repeats and suppression counts."
+        repeated = None
+        with self.lock:
+            if self.repeat:
+                repeated = (self.last[0], self.repeat)
+            self.last, self.repeat = None, 0
+            counts = [(key, b[2]) for key, b in self.buckets.items() if b[2]]
+            for b in self.buckets.values():
+                b[2] = 0
+        if repeated:
+            self.inner[repeated[0]]('last message repeated %d times',
+                                    repeated[1])
+        emit = self.inner.get(WARN, _noop)
+        for key, n in counts:
+            if isinstance(key, tuple):
+                key = f'{key[0].co_filename}:{key[1]}'
+            elif isinstance(key, types.CodeType):
+                key = f'{key.co_filename}:{key.co_firstlineno}'
+            elif isinstance(key, type):
+                key = f'{key.__name__} messages'
+            emit('suppressed %d records of %s', n, key)
+
+
+def limit(rate = 10, burst = 100, *, site = False, collapse = True):
+    """Rate limit records and collapse repeats.
+
+    Each message template (format string, or the code of a callable message)
+    may burst `burst` records, then `rate` records per second; with `site`
+    the limit applies per call site instead.  With `collapse`, identical
+    consecutive records are written once followed by 'last message repeated
+    N times'.  Suppression counts are written at exit.  limit(None) turns
+    limiting off.
+    """
+    global _limiter
+    if _limiter is not None:
+        _limiter.summary()
+        _limiter = None
+    if rate is not None:
+        _limiter = _Limiter(rate, burst, site, collapse)
+    _build()
+
+
+def aggregate(window = 0.05):
+    """Write records of this process and its forked children from one thread.
+
+    Children created by os.fork() or multiprocessing's fork start method send
+    their records, formatting left undone, to a writer thread of the calling
+    process.  Lines are tagged with the pid of their process and ordered by
+    time within `window` seconds.  aggregate(None) goes back to direct writes.
+    """
+    global _collector
+    if _collector is not None:
+        _collector.close()
+        _collector = None
+    if window is not None:
+        _collector = _Collector(window)
+    _build()
+
+
+def to_file(path, **kw):
+    """Write text logs to file `path` instead of stdout/stderr, uncolored.
+
+    The file is written through a large buffer and may be rotated by size or
+    date, rotated segments gzipped in background, see a4.logfile.Sink for
+    `kw`.  to_file(None) closes the file and goes back to stdout/stderr.
+    """
+    global _file
+    if _file is not None:
+        if _queue is not None:
+            _queue.join()
+        _file.close()
+        _file = None
+    if path is not None:
+        from a4.logfile import Sink
+        _file = Sink(path, **kw)
+    _build()
+
+
+def flush():
+    """Wait until all queued records are written, then flush the streams."""
+    global _dropped
+    if _sink is not None:
+        _sink.flush()
+    if _collector is not None and _collector.pid == os.getpid():
+        _collector.drain(float('inf'))
+    if _queue is not None:
+        _queue.join()
+        if _dropped:
+            with _dlock:
+                n, _dropped = _dropped, 0
+            warn(f'{n} log records dropped')
+            _queue.join()
+    for stream in (sys.stdout, sys.stderr) + ((_file,) if _file else ()):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+
+
+def stop():
+    """Flush and stop the background writer, back to synchronous writes."""
+    global _queue, _thread
+    if _queue is None:
+        return
+    flush()
+    _queue.put(None)
+    _thread.join()
+    _queue, _thread = None, None
+    _build()
+
+
+def _before_fork():
+    if _file is not None:
+        _file._before_fork()
+
+
+def _after_fork_parent():
+    if _file is not None:
+        _file._after_fork()
 
 
-def warn(msg):
-    if _level >= WARN:
-        print(f'{_color(33)}[{_ts()}] WARN {msg}{_color()}\n', end='',
-              file=sys.stderr if fork else sys.stdout)
+def _after_fork():
+    global _queue, _thread
+    if _file is not None:
+        _file._after_fork()
+    if _sink is not None:
+        _sink._after_fork()
+    if _collector is not None:
+        # records go to the parent's collector from now on
+        _queue, _thread = None, None
+        _build()
+    elif _queue is not None:
+        # the writer thread does not survive fork(), give the child its own
+        _start(_queue.maxsize)
 
 
-def note(msg):
-    if _level >= NOTE:
-        print(f'{_color(32)}[{_ts()}] NOTE {msg}{_color()}\n', end='',
-              file=sys.stderr if fork else sys.stdout)
+def _exit():
+    if _limiter is not None:
+        limit(None)
+    if _collector is not None:
+        aggregate(None)
+    stop()
+    if _file is not None:
+        to_file(None)
 
 
-def info(msg):
-    if _level >= INFO:
-        print(            f'[{_ts()}] INFO {msg}{_color()}\n', end='',
-              file=sys.stderr if fork else sys.stdout)
+class _Module(types.ModuleType):
+    # rebuild the emitters when `a4.log.fork` is assigned
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name == 'fork':
+            _build()
 
 
-def dbg(msg):
-    if _level >= DEBUG:
-        print(f'{_color(37)}[{_ts()}] DBG  {msg}{_color()}\n', end='',
-              file=sys.stderr if fork else sys.stdout)
+sys.modules[__name__].__class__ = _Module
+_build()
+atexit.register(_exit)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_before_fork,
+                        after_in_parent=_after_fork_parent,
+                        after_in_child=_after_fork)
 
 ### a4/log.py ends here
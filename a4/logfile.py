@@ -0,0 +1,115 @@
+################################################################################
+# a4.logfile --- buffered log file with rotation and background compression
+################################################################################
+__all__ = ['Sink']
+
+import os
+import gzip
+import queue
+import shutil
+import threading
+import time
+
+from a4 import parse_date
+
+
+class Sink:
+    """Log file written through a large buffer.
+
+    The file is rotated when it grows beyond `size` bytes, and/or with
+    `daily` at midnight.  Rotated segments are named <path>.<yyyymmdd>, with
+    .1, .2 ... appended when taken, and gzipped by a background thread with
+    `compress`.
+    """
+
+    def __init__(self, path, *, size = None, daily = False,
+                 buffer = 1 << 20, compress = True):
+        self.path = path
+        self.size = size
+        self.daily = daily
+        self.buffer = buffer
+        self.lock = threading.Lock()
+        self.jobs = None
+        if compress:
+            self.jobs = queue.Queue()
+            self.thread = threading.Thread(target=self._compress,
+                                           name='a4.logfile', daemon=True)
+            self.thread.start()
+        self._open()
+
+
+    def _open(self):
+        self.file = open(self.path, 'a', buffering=self.buffer,
+                         encoding='utf-8', errors='replace')
+        self.written = self.file.tell()
+        self.day = parse_date('today', to_str=True)
+        # next local midnight
+        t = time.localtime()
+        self.midnight = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1,
+                                     0, 0, 0, 0, 0, -1))
+
+
+    def _rotate(self):
+        self.file.close()
+        name = f'{self.path}.{self.day}'
+        n = 0
+        while os.path.exists(name) or os.path.exists(name + '.gz'):
+            n += 1
+            name = f'{self.path}.{self.day}.{n}'
+        os.rename(self.path, name)
+        if self.jobs is not None:
+            self.jobs.put(name)
+        self._open()
+
+
+    def _compress(self):
+        while True:
+            name = self.jobs.get()
+            try:
+                if name is None:
+                    return
+                with open(name, 'rb') as src, \
+                     gzip.open(name + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                os.remove(name)
+            except OSError:
+                pass
+            finally:
+                self.jobs.task_done()
+
+
+    def write(self, text):
+        with self.lock:
+            if ((self.size and self.written >= self.size) or
+                    (self.daily and time.time() >= self.midnight)):
+                self._rotate()
+            self.file.write(text)
+            self.written += len(text)
+
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+
+    def _before_fork(self):
+        # a child must not inherit lines it would write again
+        self.lock.acquire()
+        self.file.flush()
+
+
+    def _after_fork(self):
+        self.lock.release()
+
+
+    def close(self):
+        "Close the file and wait for pending compression."
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.close()
+        if self.jobs is not None:
+            self.jobs.put(None)
+            self.thread.join()
+
+### a4/logfile.py ends here
@@ -0,0 +1,231 @@
+################################################################################
+# a4.metrics --- counters, gauges and histograms of a run
+################################################################################
+"""Metrics of a Runnable app, made by AppBase._counter(), _gauge() and
+_histogram().  Look them up once, out of hot loops, then update them with a
+plain method call:
+
+    rows = self._counter('rows')
+    secs = self._histogram('load_secs')
+    for ...:
+        rows.inc()
+        secs.observe(elapsed)
+
+A summary is written when the command ends: logged, or as JSON with -M <file>.
+"""
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Metrics', 'LATENCY']
+
+import os
+from bisect import bisect_left
+
+import a4.log as log
+
+
+# default histogram buckets, latencies in seconds
+LATENCY = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    __slots__ = ('name', 'value')
+    kind = 'counter'
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+
+    def inc(self, n = 1):
+        self.value += n
+
+
+    def summary(self):
+        return self.value
+
+
+    def _state(self):
+        return self.value
+
+
+    def _merge(self, state):
+        self.value += state
+
+
+    def _reset(self):
+        self.value = 0
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+    def dec(self, n = 1):
+        self.value -= n
+
+
+    def _merge(self, state):
+        self.value = state
+
+
+    def _reset(self):
+        pass
+
+
+class Histogram:
+    """Observations counted in fixed buckets, bucket i holding values up to
+    bounds[i], the last one values beyond bounds[-1].
+    """
+    __slots__ = ('name', 'bounds', 'counts', 'count', 'sum', 'min', 'max')
+    kind = 'histogram'
+
+    def __init__(self, name, bounds = LATENCY):
+        self.name = name
+        self.bounds = tuple(sorted(bounds))
+        self._reset()
+
+
+    def observe(self, x):
+        self.counts[bisect_left(self.bounds, x)] += 1
+        self.count += 1
+        self.sum += x
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+
+    def quantile(self, q):
+        "Upper bound of the bucket holding quantile `q`, or max beyond."
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count,
+                'min': self.min, 'max': self.max,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99),
+                'buckets': [[b, n] for b, n in
+                            zip(self.bounds + ('inf',), self.counts) if n]}
+
+
+    def _state(self):
+        return (self.bounds, self.counts, self.count, self.sum,
+                self.min, self.max)
+
+
+    def _merge(self, state):
+        bounds, counts, count, total, lo, hi = state
+        if tuple(bounds) != self.bounds:
+            raise ValueError(f'{self.name}: histogram buckets differ')
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.count += count
+        self.sum += total
+        self.min = min(self.min, lo)
+        self.max = max(self.max, hi)
+
+
+    def _reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+
+_KINDS = {cls.kind: cls for cls in (Counter, Gauge, Histogram)}
+
+
+class Metrics:
+    "Metrics of a run by name."
+
+    def __init__(self):
+        self.items = {}
+
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+    def _get(self, cls, name, *args):
+        item = self.items.get(name)
+        if item is None:
+            item = self.items[name] = cls(name, *args)
+        elif type(item) is not cls:
+            raise TypeError(f'metric {name} is a {item.kind}')
+        return item
+
+
+    def counter(self, name):
+        return self._get(Counter, name)
+
+
+    def gauge(self, name):
+        return self._get(Gauge, name)
+
+
+    def histogram(self, name, bounds = LATENCY):
+        return self._get(Histogram, name, bounds)
+
+
+    def summary(self):
+        return {name: item.summary() for name, item in self.items.items()}
+
+
+    def state(self):
+        "Marshallable state, for merge() in another process."
+        return {name: (item.kind, item._state())
+                for name, item in self.items.items()}
+
+
+    def merge(self, state):
+        "Add the counts of state(), and take its gauges."
+        for name, (kind, value) in state.items():
+            cls = _KINDS[kind]
+            args = (tuple(value[0]),) if cls is Histogram else ()
+            self._get(cls, name, *args)._merge(value)
+
+
+    def reset(self):
+        "Zero counters and histograms for the next run, gauges stay."
+        for item in self.items.values():
+            item._reset()
+
+
+    def report(self, path = None, **info):
+        """Write the summary as JSON with `info` to `path` atomically, or log
+        it if no path.
+        """
+        if path:
+            import json
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(dict(info, metrics=self.summary()), f, indent=1)
+                f.write('\n')
+            os.replace(tmp, path)
+            return
+        for name, item in self.items.items():
+            if item.kind != 'histogram':
+                log.note('%s = %s', name, item.value)
+            elif item.count:
+                log.note('%s: n=%d mean=%.6g min=%.6g p50<=%.6g p95<=%.6g'
+                         ' p99<=%.6g max=%.6g', name, item.count,
+                         item.sum / item.count, item.min, item.quantile(0.5),
+                         item.quantile(0.95), item.quantile(0.99), item.max)
+            else:
+                log.note('%s: n=0', name)
+
+### a4/metrics.py ends here
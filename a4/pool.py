@@ -0,0 +1,190 @@
+################################################################################
+# a4.pool --- connection pools keyed by parse_url() DSNs
+################################################################################
+__all__ = ['Pool', 'Registry', 'close_all']
+
+import time
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+
+from a4 import parse_url
+
+
+# live registries, closed by close_all() at the end of a Runnable run
+_registries = weakref.WeakSet()
+
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, list):
+        return tuple(_freeze(x) for x in obj)
+    return obj
+
+
+@lru_cache(maxsize=256)
+def _parse(url, kw):
+    dsn = parse_url(url, **dict(kw))
+    return _freeze(dsn), dsn
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class Pool:
+    """At most `size` connections made by `factory(dsn)`.
+
+    Idle connections are reused last in, first out, and closed after `idle`
+    seconds unused.  `check(conn)`, if given, is called before handing out
+    an idle connection; a connection failing it is closed and replaced.
+    """
+
+    def __init__(self, factory, dsn, *, size = 4, idle = 300, check = None):
+        self.factory = factory
+        self.dsn = dsn
+        self.size = size
+        self.idle = idle
+        self.check = check
+        self.free = deque()  # (conn, time returned)
+        self.count = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+
+    def _evict(self):
+        horizon = time.monotonic() - self.idle
+        while self.free and self.free[0][1] < horizon:
+            _close(self.free.popleft()[0])
+            self.count -= 1
+
+
+    def get(self, timeout = None):
+        "Check out a connection, waiting up to `timeout` seconds if all busy."
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.cond:
+                if self.closed:
+                    raise RuntimeError('pool closed')
+                self._evict()
+                if self.free:
+                    conn = self.free.pop()[0]
+                elif self.count < self.size:
+                    self.count += 1
+                    conn = None
+                else:
+                    left = None if deadline is None else \
+                        deadline - time.monotonic()
+                    if left is not None and left <= 0:
+                        raise TimeoutError(f'no free connection in {timeout}s')
+                    self.cond.wait(left)
+                    continue
+            if conn is None:
+                try:
+                    return self.factory(self.dsn)
+                except BaseException:
+                    with self.cond:
+                        self.count -= 1
+                        self.cond.notify()
+                    raise
+            if self.check is None or self._healthy(conn):
+                return conn
+            _close(conn)
+            with self.cond:
+                self.count -= 1
+
+
+    def _healthy(self, conn):
+        try:
+            return self.check(conn)
+        except Exception:
+            return False
+
+
+    def put(self, conn):
+        "Return a connection checked out by get()."
+        with self.cond:
+            if self.closed:
+                _close(conn)
+                self.count -= 1
+                return
+            self.free.append((conn, time.monotonic()))
+            self.cond.notify()
+
+
+    @contextmanager
+    def connection(self, timeout = None):
+        conn = self.get(timeout)
+        try:
+            yield conn
+        finally:
+            self.put(conn)
+
+
+    def close(self):
+        "Close idle connections, busy ones are closed when put back."
+        with self.cond:
+            self.closed = True
+            while self.free:
+                _close(self.free.pop()[0])
+                self.count -= 1
+            self.cond.notify_all()
+
+
+class Registry:
+    """Pools of `factory` connections, one per DSN.
+
+    URLs are parsed by a4.parse_url() once; URLs parsing to the same DSN
+    share a pool.  `kw` are Pool options.
+    """
+
+    def __init__(self, factory, **kw):
+        self.factory = factory
+        self.kw = kw
+        self.pools = {}
+        self.lock = threading.Lock()
+        _registries.add(self)
+
+
+    def pool(self, url, **defaults):
+        "Pool of `url`, `defaults` are passed to parse_url()."
+        try:
+            key, dsn = _parse(url, tuple(sorted(defaults.items())))
+        except TypeError:
+            # a path list or param dict is no cache key, parse every time
+            dsn = parse_url(url, **defaults)
+            key = _freeze(dsn)
+        pool = self.pools.get(key)
+        if pool is None:
+            with self.lock:
+                pool = self.pools.get(key)
+                if pool is None:
+                    pool = self.pools[key] = Pool(self.factory, dict(dsn),
+                                                  **self.kw)
+        return pool
+
+
+    def connection(self, url, timeout = None, **defaults):
+        "Context manager checking out a connection of `url`."
+        return self.pool(url, **defaults).connection(timeout)
+
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = list(self.pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+
+def close_all():
+    "Close every registry."
+    for reg in list(_registries):
+        reg.close()
+
+### a4/pool.py ends here
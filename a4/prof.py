@@ -0,0 +1,139 @@
+################################################################################
+# a4.prof --- profile the phases of a Runnable command
+################################################################################
+"""Selected with the global option -P <mode>[:<arg>] of Runnable apps:
+
+    cpu[:N]             cProfile, top N (25) functions by cumulative time
+    cpu:<file>.pstats   cProfile, saved to <file>.<phase>.pstats for pstats
+    mem[:N]             tracemalloc, peak and top N (10) allocation sites
+    sample[:ms]         sampling the stack every ms (5) of CPU time
+
+`_init`, the command and `_cleanup` are profiled and reported separately, on
+stderr.
+"""
+__all__ = ['Profiler']
+
+import sys
+import time
+from contextlib import contextmanager
+
+
+def _say(text):
+    print(text, file=sys.stderr)
+
+
+class Profiler:
+    def __init__(self, spec):
+        mode, _, arg = spec.partition(':')
+        self.mode = mode
+        self.path = None
+        if mode == 'cpu':
+            if arg.endswith('.pstats'):
+                self.path, arg = arg[:-len('.pstats')], ''
+            self.top = int(arg or 25)
+        elif mode == 'mem':
+            self.top = int(arg or 10)
+        elif mode == 'sample':
+            self.interval = float(arg or 5) / 1000
+            self.top = 25
+        else:
+            raise ValueError(f'unknown profile mode {mode!r}')
+
+
+    def phase(self, name):
+        "Context manager profiling phase `name`, reported at its end."
+        return getattr(self, '_' + self.mode)(name)
+
+
+    def _head(self, name, t0):
+        _say(f'==== {name}: {time.perf_counter() - t0:.3f}s wall')
+
+
+    @contextmanager
+    def _cpu(self, name):
+        import cProfile
+        prof = cProfile.Profile()
+        t0 = time.perf_counter()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            self._head(name, t0)
+            if self.path:
+                path = f'{self.path}.{name.strip("_")}.pstats'
+                prof.dump_stats(path)
+                _say(f'  saved to {path}')
+            else:
+                import pstats
+                stats = pstats.Stats(prof, stream=sys.stderr)
+                stats.sort_stats('cumulative').print_stats(self.top)
+
+
+    @contextmanager
+    def _mem(self, name):
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        base = tracemalloc.take_snapshot()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            snap = tracemalloc.take_snapshot()
+            if not tracing:
+                tracemalloc.stop()
+            self._head(name, t0)
+            _say(f'  peak {peak / 2**20:.1f} MiB traced,'
+                 f' {current / 2**20:.1f} MiB at end')
+            ours = [tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, __file__)]
+            stats = snap.filter_traces(ours).compare_to(base, 'lineno')
+            for stat in stats[:self.top]:
+                _say(f'  {stat}')
+
+
+    @contextmanager
+    def _sample(self, name):
+        import signal
+        from collections import Counter
+        own, total = Counter(), Counter()
+        count = 0
+
+        def tick(signum, frame):
+            nonlocal count
+            count += 1
+            code = frame.f_code
+            own[(code.co_name, code.co_filename, frame.f_lineno)] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                if code not in seen:
+                    seen.add(code)
+                    total[code] += 1
+                frame = frame.f_back
+
+        old = signal.signal(signal.SIGPROF, tick)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, old)
+            self._head(name, t0)
+            _say(f'  {count} samples, every {self.interval * 1000:g}ms of CPU')
+            # no return here, which would swallow the phase's exception
+            if count:
+                _say('  own time:')
+                for (func, path, line), n in own.most_common(self.top):
+                    _say(f'  {100 * n / count:5.1f}%  {func} ({path}:{line})')
+                _say('  with callees:')
+                for code, n in total.most_common(self.top):
+                    _say(f'  {100 * n / count:5.1f}%  {code.co_name}'
+                         f' ({code.co_filename}:{code.co_firstlineno})')
+
+### a4/prof.py ends here
@@ -0,0 +1,157 @@
+################################################################################
+# a4.rangeset --- sorted disjoint integer or date intervals
+################################################################################
+__all__ = ['RangeSet']
+
+import datetime as dt
+from array import array
+from bisect import bisect_right
+
+from a4 import parse_range, parse_date_range
+
+
+def _ordinal(num):
+    return dt.date(num // 10000, num // 100 % 100, num % 100).toordinal()
+
+
+def _yyyymmdd(ordinal):
+    d = dt.date.fromordinal(ordinal)
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+def _merge(spans):
+    "Merge sorted (first, last) pairs into interval arrays."
+    begs, ends = array('q'), array('q')
+    for b, e in spans:
+        if b > e:
+            continue
+        if ends and b <= ends[-1] + 1:
+            if e > ends[-1]:
+                ends[-1] = e
+        else:
+            begs.append(b)
+            ends.append(e)
+    return begs, ends
+
+
+class RangeSet:
+    """Set of ints, or yyyymmdd dates with `dates`, kept as merged, sorted,
+    inclusive intervals.  Membership is a binary search, len() and set
+    operations work on intervals without expanding them.
+
+    Dates are stored as day ordinals, so that 20240131-20240201 is one
+    interval of two days.
+    """
+
+    def __init__(self, intervals = (), *, dates = False):
+        self.dates = dates
+        conv = _ordinal if dates else int
+        self.begs, self.ends = _merge(sorted((conv(b), conv(e))
+                                             for b, e in intervals))
+
+
+    @classmethod
+    def parse(cls, spec, *, sep='-', comma=',', dates = False):
+        """RangeSet of a parse_range spec such as '1-9,20-25', or with
+        `dates` of comma separated parse_date_range specs.
+        """
+        items = spec.split(comma) if comma else [spec]
+        if dates:
+            return cls([parse_date_range(x, sep=sep) for x in items],
+                       dates=True)
+        return cls([parse_range(x, sep=sep, comma=None) for x in items])
+
+
+    @classmethod
+    def _raw(cls, begs, ends, dates):
+        ret = cls.__new__(cls)
+        ret.dates, ret.begs, ret.ends = dates, begs, ends
+        return ret
+
+
+    def _key(self, x):
+        if not self.dates:
+            return x
+        try:
+            return _ordinal(x)
+        except (TypeError, ValueError):
+            return None
+
+
+    def __contains__(self, x):
+        x = self._key(x)
+        if x is None:
+            return False
+        i = bisect_right(self.begs, x) - 1
+        return i >= 0 and x <= self.ends[i]
+
+
+    def __len__(self):
+        return sum(self.ends) - sum(self.begs) + len(self.begs)
+
+
+    def __bool__(self):
+        return len(self.begs) > 0
+
+
+    def __iter__(self):
+        out = _yyyymmdd if self.dates else None
+        for b, e in zip(self.begs, self.ends):
+            if out is None:
+                yield from range(b, e + 1)
+            else:
+                yield from map(out, range(b, e + 1))
+
+
+    def intervals(self):
+        "Yield (first, last) of every interval."
+        out = _yyyymmdd if self.dates else int
+        for b, e in zip(self.begs, self.ends):
+            yield (out(b), out(e))
+
+
+    def _check(self, other):
+        if self.dates != other.dates:
+            raise ValueError('cannot mix date and integer range sets')
+
+
+    def __or__(self, other):
+        if not isinstance(other, RangeSet):
+            return NotImplemented
+        self._check(other)
+        spans = sorted(zip(self.begs + other.begs, self.ends + other.ends))
+        return self._raw(*_merge(spans), self.dates)
+
+
+    def __and__(self, other):
+        if not isinstance(other, RangeSet):
+            return NotImplemented
+        self._check(other)
+        ret = self._raw(array('q'), array('q'), self.dates)
+        i = j = 0
+        while i < len(self.begs) and j < len(other.begs):
+            b = max(self.begs[i], other.begs[j])
+            e = min(self.ends[i], other.ends[j])
+            if b <= e:
+                ret.begs.append(b)
+                ret.ends.append(e)
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return ret
+
+
+    def __eq__(self, other):
+        if not isinstance(other, RangeSet):
+            return NotImplemented
+        return (self.dates == other.dates and self.begs == other.begs and
+                self.ends == other.ends)
+
+
+    def __repr__(self):
+        spans = ','.join(str(b) if b == e else f'{b}-{e}'
+                         for b, e in self.intervals())
+        return f'RangeSet({spans!r}{", dates=True" if self.dates else ""})'
+
+### a4/rangeset.py ends here
@@ -0,0 +1,230 @@
+################################################################################
+# a4.server --- keep a Runnable app warm behind a Unix socket
+################################################################################
+"""Started with `app -S <socket>`, a Runnable app forks `_serve_workers`
+worker processes.  Each runs `_init` once, then sub-commands sent by a4.client
+one at a time, with the client's stdin, stdout, stderr and working
+directory, and replies with the exit code a direct run would have had.
+`_cleanup` runs when a worker quits: after `_serve_requests` commands, to
+contain leaks, when it is replaced by a fresh one, or on SIGTERM / SIGINT,
+which stop the server.  A failing `_init` stops the server too, and workers
+dying early are replaced after a growing delay.
+"""
+__all__ = ['serve']
+
+import os
+import sys
+import stat
+import signal
+import socket
+import struct
+import time
+
+from a4 import get_opts
+from a4.app import GLOBAL_SPEC
+import a4.log as log
+
+# exit code of a worker whose _init failed, which stops the server
+_INIT_FAILED = 3
+# workers dying younger than this many seconds are replaced after a delay
+# doubling up to _MAX_DELAY
+_EARLY = 1.0
+_MAX_DELAY = 10.0
+
+
+def _recv(conn, n):
+    buf = b''
+    while len(buf) < n:
+        data = conn.recv(n - len(buf))
+        if not data:
+            raise ConnectionError('client closed connection')
+        buf += data
+    return buf
+
+
+def _excode(e):
+    "Exit status of SystemExit `e`, as the interpreter makes it."
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def _flush():
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+
+def _run(app, argv, fds, argv0):
+    "Run `argv` with `fds` as stdin, stdout and stderr."
+    saved = [os.dup(fd) for fd in (0, 1, 2)]
+    cwd, level, pipe = os.getcwd(), log.level(), log._pipe
+    _flush()
+    for fd, new in zip((0, 1, 2), fds):
+        os.dup2(new, fd)
+    try:
+        os.chdir(argv[0])
+        sys.argv = [argv0] + argv[1:]
+        log._pipe = not sys.stdout.isatty()
+        log.level(level)    # rebuild emitters for the client's terminal
+        app.app.excode = 0
+        try:
+            (opts, args) = get_opts(GLOBAL_SPEC, argv[1:], greedy=False,
+                                    argfiles=app.app._argfiles)
+            app.dispatch(opts, args, warm=True)
+            return app.app.excode
+        except SystemExit as e:
+            return _excode(e)
+        except BaseException as e:
+            # uncaught, say raised by _finally: as the interpreter reports it
+            import traceback
+            traceback.print_exc()
+            return 130 if isinstance(e, KeyboardInterrupt) else 1
+    finally:
+        log.flush()
+        _flush()
+        for fd, old in zip((0, 1, 2), saved):
+            os.dup2(old, fd)
+            os.close(old)
+        os.chdir(cwd)
+        log._pipe = pipe
+        log.level(level)
+
+
+def _handle(app, conn, argv0):
+    head, fds, _, _ = socket.recv_fds(conn, 4, 3)
+    try:
+        if len(fds) != 3:
+            raise ConnectionError('expected stdin, stdout and stderr')
+        head += _recv(conn, 4 - len(head))
+        req = _recv(conn, struct.unpack('!I', head)[0])
+        argv = req.decode('utf-8', 'surrogateescape').split('\0')
+        code = _run(app, argv, fds, argv0)
+    finally:
+        for fd in fds:
+            os.close(fd)
+    conn.sendall(struct.pack('!i', code))
+
+
+def _worker(app, sock, requests):
+    # a command interrupted by a signal still exits through sys.exit(), so
+    # remember to quit once it has replied
+    stop = []
+    def interrupt(signum, frame):
+        stop.append(signum)
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+    signal.signal(signal.SIGINT, interrupt)
+    argv0 = sys.argv[0]
+    if app._has_async(app.cmds + ['_init', '_finally', '_cleanup']):
+        # one loop for the life of the worker, as for a direct run
+        import asyncio
+        app.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(app.loop)
+    try:
+        app.hook('_init')
+    except (Exception, SystemExit):
+        import traceback
+        traceback.print_exc()
+        if app.loop is not None:
+            app.loop.close()
+        log.flush()
+        return _INIT_FAILED
+    try:
+        for _ in range(requests):
+            if stop:
+                break
+            conn, _ = sock.accept()
+            with conn:
+                try:
+                    _handle(app, conn, argv0)
+                except Exception as e:
+                    log.warn('request failed: %s', e)
+    finally:
+        app.hook('_cleanup')
+        if 'a4.pool' in sys.modules:
+            sys.modules['a4.pool'].close_all()
+        if app.loop is not None:
+            app.loop.close()
+        log.flush()
+    return 0
+
+
+def _bind(path):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)     # left over by a server killed hard
+    except FileNotFoundError:
+        pass
+    # appear listening, so that clients may wait for the path
+    tmp = f'{path}.{os.getpid()}'
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(tmp)
+    sock.listen(128)
+    os.rename(tmp, path)
+    return sock
+
+
+def serve(app, path, *, workers = 4, requests = 1000):
+    """Serve sub-commands of Runnable `app` on Unix socket `path` with
+    `workers` processes, each replaced after `requests` commands.  Return
+    the exit code, 2 if a worker failed to initialize.
+    """
+    sock = _bind(path)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    log.note('serving on %s, %d workers', path, workers)
+    pids = {}   # pid: start time
+    excode, delay = 0, 0
+    try:
+        while True:
+            while len(pids) < workers:
+                _flush()
+                pid = os.fork()
+                if pid == 0:
+                    code = 0
+                    try:
+                        code = _worker(app, sock, requests)
+                    except KeyboardInterrupt:
+                        pass
+                    except BaseException:
+                        import traceback
+                        traceback.print_exc()
+                        code = 2
+                    finally:
+                        _flush()
+                        os._exit(code)
+                pids[pid] = time.monotonic()
+            pid, status = os.wait()
+            age = time.monotonic() - pids.pop(pid)
+            code = os.waitstatus_to_exitcode(status)
+            if code == _INIT_FAILED:
+                log.err('worker failed to initialize, stopping')
+                excode = 2
+                break
+            if code == 0 or age >= _EARLY:
+                delay = 0
+            else:
+                delay = min(_MAX_DELAY, delay * 2 or 0.1)
+                log.warn('worker %d exited with %d after %.2fs, replacing '
+                         'it in %.1fs', pid, code, age, delay)
+                time.sleep(delay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+        sock.close()
+        os.unlink(path)
+    return excode
+
+### a4/server.py ends here
@@ -0,0 +1,184 @@
+################################################################################
+# a4.trace --- timed spans exported as Chrome trace events
+################################################################################
+"""Spans time named stages, as context managers or decorators:
+
+    with span('load'):
+        ...
+
+    @span('transform')
+    def transform(rows):
+        ...
+
+Nothing is recorded until start(); spans then go into preallocated arrays,
+and stop(path) writes them as Chrome / Perfetto trace-event JSON.  Runnable
+apps do so with -T <file>, with `_init`, the command and `_cleanup` as top
+level spans.
+"""
+__all__ = ['span', 'start', 'stop', 'Tracer']
+
+import os
+import time
+import threading
+from array import array
+from functools import wraps
+from itertools import count
+
+
+class Tracer:
+    """Completed spans in arrays of `capacity` entries, spans beyond are
+    counted as dropped.  Slots are taken from an atomic counter, so threads
+    record without a lock.
+    """
+
+    def __init__(self, capacity = 1 << 16):
+        self.capacity = capacity
+        self.names = [None] * capacity
+        self.begins = array('q', bytes(8 * capacity))
+        self.ends = array('q', bytes(8 * capacity))
+        self.tids = array('q', bytes(8 * capacity))
+        self.slot = count().__next__
+        self.used = None
+
+
+    def add(self, name, begin, end):
+        i = self.slot()
+        if i < self.capacity:
+            self.names[i] = name
+            self.begins[i] = begin
+            self.ends[i] = end
+            self.tids[i] = threading.get_native_id()
+
+
+    def close(self):
+        "Stop taking spans, return the number dropped."
+        if self.used is None:
+            self.used = self.slot()
+        return max(0, self.used - self.capacity)
+
+
+    def events(self):
+        "Chrome trace events of the spans, times in microseconds."
+        dropped = self.close()
+        pid = os.getpid()
+        n = min(self.used, self.capacity)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                   'args': {'name': f'pid {pid}'}}]
+        names = {t.native_id: t.name for t in threading.enumerate()}
+        for tid in sorted(set(self.tids[:n])):
+            if tid in names:
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                               'tid': tid, 'args': {'name': names[tid]}})
+        # by start, outer spans first where they start together
+        for i in sorted(range(n), key=lambda i: (self.begins[i],
+                                                 -self.ends[i])):
+            events.append({'name': self.names[i], 'ph': 'X', 'pid': pid,
+                           'tid': self.tids[i],
+                           'ts': self.begins[i] / 1000,
+                           'dur': (self.ends[i] - self.begins[i]) / 1000})
+        if dropped:
+            events[0]['args']['dropped_spans'] = dropped
+        return events
+
+
+    def export(self, path):
+        "Write the spans as trace-event JSON to `path` atomically."
+        import json
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': self.events(),
+                       'displayTimeUnit': 'ms'}, f)
+        os.replace(tmp, path)
+
+
+_tracer = None
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'begin')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+
+    def __enter__(self):
+        self.begin = time.perf_counter_ns()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.begin, time.perf_counter_ns())
+
+
+    def __call__(self, func):
+        return _traced(self.name, func)
+
+
+class _Off:
+    "span() while not tracing, one per name."
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        pass
+
+
+    def __call__(self, func):
+        return _traced(self.name, func)
+
+
+_off = {}
+
+
+def _traced(name, func):
+    code = getattr(func, '__code__', None)
+    if code is not None and code.co_flags & 0x80:    # async def
+        @wraps(func)
+        async def traced(*args, **kw):
+            with span(name):
+                return await func(*args, **kw)
+        return traced
+
+    @wraps(func)
+    def traced(*args, **kw):
+        with span(name):
+            return func(*args, **kw)
+    return traced
+
+
+def span(name):
+    "Context manager, or decorator, recording a span `name` while tracing."
+    tracer = _tracer
+    if tracer is None:
+        off = _off.get(name)
+        if off is None:
+            off = _off[name] = _Off(name)
+        return off
+    return _Span(tracer, name)
+
+
+def start(capacity = 1 << 16):
+    "Record spans from now on, up to `capacity`."
+    global _tracer
+    _tracer = Tracer(capacity)
+
+
+def stop(path = None):
+    "Stop recording, write trace events to `path` if given; return the Tracer."
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+        if path:
+            tracer.export(path)
+    return tracer
+
+### a4/trace.py ends here
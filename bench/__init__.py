@@ -0,0 +1,70 @@
+################################################################################
+# bench --- timing and allocation helpers of the benchmark suite
+################################################################################
+import gc
+import sys
+import time
+from itertools import repeat
+
+
+def _time(func, n):
+    gc.disable()
+    try:
+        t0 = time.perf_counter()
+        for _ in repeat(None, n):
+            func()
+        return time.perf_counter() - t0
+    finally:
+        gc.enable()
+
+
+def ops_per_sec(func, *, secs = 0.2, rounds = 3):
+    "Best rate of `func()` calls over `rounds` runs of about `secs` each."
+    n = 1
+    while True:
+        t = _time(func, n)
+        if t >= secs / 10:
+            break
+        n *= 10
+    n = max(1, int(n * secs / t))
+    return n / min(_time(func, n) for _ in range(rounds))
+
+
+def allocations(func, n = 1000):
+    """(peak bytes allocated by one call, memory blocks kept per call over
+    `n` calls) of `func()`, warmed up first.
+    """
+    import tracemalloc
+    func()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    for _ in repeat(None, n):
+        func()
+    gc.collect()
+    return peak, (sys.getallocatedblocks() - blocks) / n
+
+
+def compare(results, baseline, threshold):
+    """Names of results whose ops/sec fell more than `threshold` (a ratio)
+    below the baseline, with the change.
+    """
+    worse = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        change = res['ops'] / base['ops'] - 1
+        if change < -threshold:
+            worse.append((name, change))
+    return worse
+
+### bench/__init__.py ends here
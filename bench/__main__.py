@@ -0,0 +1,173 @@
+################################################################################
+# bench --- benchmark suite of a4 hot paths
+################################################################################
+"""Usage: python3 -m bench [-s] [-b <file>] [-t <ratio>] [name ...]
+
+Report ops/sec, peak bytes allocated by one call and memory blocks kept per
+call of a4 hot paths, compared with the JSON baseline <file>
+(bench/baseline.json).  Exits 1 if any rate fell by more than <ratio> (0.2).
+
+    -s          save the results as the baseline
+"""
+import os
+import sys
+import json
+import platform
+import subprocess
+from functools import partial
+
+from a4 import (get_opts, parse_date, parse_date_range, parse_url,
+                parse_opts, parse_cmd_spec)
+import a4.log as log
+from a4.app import GLOBAL_SPEC
+
+from bench import ops_per_sec, allocations, compare
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SPEC = '''[-c <cal_id>] <yyyy> mmdd-mmdd [mmdd-mmdd ...]
+    Generate trading calendar for one year.
+    -c <cal_id>     calendar ID, default 86
+    -o, --output <file>   output file
+    --verbose       be verbose
+'''
+
+
+class _Null:
+    def write(self, s):
+        pass
+    def flush(self):
+        pass
+
+
+# name: generator yielding the function to time, cleaning up after
+def log_info():
+    out, sys.stdout = sys.stdout, _Null()
+    log.level('i')
+    try:
+        yield partial(log.info, 'processed row %d of table %s', 12345,
+                      'quotes')
+    finally:
+        sys.stdout = out
+
+
+def log_dbg_off():
+    log.level('i')
+    yield partial(log.dbg, 'processed row %d of table %s', 12345, 'quotes')
+
+
+def date():
+    yield partial(parse_date, '2024-02-29')
+
+
+def date_rel():
+    yield partial(parse_date, 'yest3')
+
+
+def date_range():
+    yield partial(parse_date_range, '202401-03')
+
+
+def url():
+    yield partial(parse_url, 'mysql://user:p@ss@db.example.com:3306/quotes'
+                  '?charset=utf8&timeout=10')
+
+
+def opts():
+    yield partial(parse_opts, SPEC, ['-c', '42', '--output', 'cal.txt',
+                                     '2024', '0101-0103'])
+
+
+def cmd_spec():
+    yield partial(parse_cmd_spec, SPEC)
+
+
+def app_dispatch():
+    from bench.sample import Sample
+    app = Sample()
+    gopts, _ = get_opts(GLOBAL_SPEC, [])
+    def dispatch():
+        try:
+            app.dispatch(gopts, ['noop', '-c', '42', 'x'])
+        except SystemExit:
+            pass
+    yield dispatch
+
+
+def app_startup():
+    cmd = [sys.executable, '-m', 'bench.sample', 'noop']
+    yield partial(subprocess.run, cmd, cwd=ROOT, check=True)
+
+
+CASES = {'log.info': log_info, 'log.dbg.off': log_dbg_off,
+         'parse_date': date, 'parse_date.rel': date_rel,
+         'parse_date_range': date_range, 'parse_url': url,
+         'parse_opts': opts, 'parse_cmd_spec': cmd_spec,
+         'app.dispatch': app_dispatch, 'app.startup': app_startup}
+
+# timed by wall clock only, allocations are another process's
+_COLD = {'app.startup'}
+
+
+def run(name):
+    case = CASES[name]()
+    func = next(case)
+    try:
+        res = {'ops': ops_per_sec(func, secs=1 if name in _COLD else 0.2)}
+        if name not in _COLD:
+            res['peak'], res['kept'] = allocations(func)
+    finally:
+        case.close()
+    return res
+
+
+def main():
+    flags, names = get_opts('sb:t:', greedy=True)
+    path = flags['b'] or os.path.join(ROOT, 'bench', 'baseline.json')
+    threshold = float(flags['t'] or 0.2)
+    for name in names:
+        if name not in CASES:
+            sys.exit(f"unknown benchmark '{name}'")
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    print(f'{"":18s} {"ops/sec":>12s} {"peak B":>8s} {"kept":>6s}'
+          f' {"baseline":>12s} {"change":>7s}')
+    for name in names or CASES:
+        res = results[name] = run(name)
+        base = baseline.get(name)
+        line = f'{name:18s} {res["ops"]:12,.0f}'
+        if 'peak' in res:
+            line += f' {res["peak"]:8d} {res["kept"]:6.2f}'
+        else:
+            line += f' {1000 / res["ops"]:6.1f}ms {"":6s}'
+        if base:
+            line += (f' {base["ops"]:12,.0f}'
+                     f' {100 * (res["ops"] / base["ops"] - 1):+6.1f}%')
+        print(line, flush=True)
+
+    if flags['s']:
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': dict(baseline, **results)}, f, indent=1)
+            f.write('\n')
+        os.replace(tmp, path)
+        print(f'saved to {path}')
+        return
+    worse = compare(results, baseline, threshold)
+    for name, change in worse:
+        print(f'REGRESSION {name}: {100 * change:+.1f}%'
+              f' beyond {100 * threshold:g}%', file=sys.stderr)
+    sys.exit(1 if worse else 0)
+
+
+if __name__ == '__main__':
+    main()
+
+### bench/__main__.py ends here
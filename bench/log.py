@@ -0,0 +1,49 @@
+################################################################################
+# bench.log --- lines/sec of a4.log emitters
+################################################################################
+import os
+import sys
+import time
+import tempfile
+
+import a4.log as log
+
+
+class _Null:
+    def write(self, s):
+        pass
+    def flush(self):
+        pass
+
+
+def lines_per_sec(func, n = 200000):
+    out, sys.stdout = sys.stdout, _Null()
+    try:
+        t0 = time.perf_counter()
+        for i in range(n):
+            func('processed row 12345 of table quotes')
+        t1 = time.perf_counter()
+    finally:
+        sys.stdout = out
+    return n / (t1 - t0)
+
+
+def main():
+    log.level('i')
+    for name in ['info', 'warn', 'dbg']:
+        rate = lines_per_sec(getattr(log, name))
+        print(f'{name:5s} {rate:12,.0f} lines/sec')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log.binary(os.path.join(tmp, 'bench.blog'))
+        try:
+            rate = lines_per_sec(log.info)
+        finally:
+            log.binary(None)
+        print(f'{"bin":5s} {rate:12,.0f} lines/sec')
+
+
+if __name__ == '__main__':
+    main()
+
+### bench/log.py ends here
@@ -0,0 +1,22 @@
+################################################################################
+# bench.sample --- small Runnable app timed by the benchmark suite
+################################################################################
+from a4 import parse_opts
+from a4.app import AppBase, Runnable
+
+
+@Runnable
+class Sample(AppBase):
+    def noop(self, args):
+        """[-c <cal_id>] [args ...]
+        Parse options and return.
+        -c <cal_id>     calendar ID, default 86
+        --verbose       be verbose
+        """
+        opts, args = parse_opts(self.noop.__doc__, args)
+
+
+if __name__ == '__main__':
+    Sample().run()
+
+### bench/sample.py ends here
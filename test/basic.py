@@ -1,6 +1,16 @@
+import io
+import os
+import gzip
+import re
+import sys
+import tempfile
+import time
+import subprocess
 import unittest
 import datetime as dt
+from contextlib import redirect_stdout, redirect_stderr
 from a4 import *
+import a4.log as log
 
 class TestAux(unittest.TestCase):
     def test_parse_range(self):
@@ -35,6 +45,18 @@ class TestAux(unittest.TestCase):
         with self.assertRaises(ValueError):
             parse_date('2019')
 
+    def test_parse_dates(self):
+        specs = ['20200101', '2020/12-32', 'today', 'yest', 'yest2', 'tomo5',
+                 'this', 'yest', '20200101']
+        ret = parse_dates(specs)
+        self.assertEqual(ret.typecode, 'i')
+        self.assertEqual(list(ret), [parse_date(x) for x in specs])
+        with self.assertRaises(ValueError):
+            parse_dates(['20200101', 'junk'])
+        begs, ends = parse_date_ranges(['202001-2', '2020', '202001-2'])
+        self.assertEqual(list(begs), [20200101, 20200101, 20200101])
+        self.assertEqual(list(ends), [20200229, 20201231, 20200229])
+
     def test_parse_url(self):
         self.assertEqual(parse_url(''), {})
         self.assertEqual(parse_url('', abc = 123), {})
@@ -131,5 +153,1061 @@ class TestAux(unittest.TestCase):
         self.assertEqual(opt['g'], None)
         self.assertEqual(args, ['a', 'b', '-g'])
 
+    def test_compile_spec(self):
+        spec = '''
+-b, --bbb         bool
+-e, --eee  <int>  arg
+'''
+        self.assertIs(compile_spec(spec), compile_spec(spec))
+        opt, args = parse_opts(compile_spec(spec), '-b --eee 3 x'.split())
+        self.assertEqual((opt['b'], opt['bbb'], opt['eee'], opt['e']),
+                         (True, False, '3', None))
+        self.assertEqual(args, ['x'])
+        opt2, _ = parse_opts(spec, [])
+        self.assertEqual(opt2['b'], False)
+        self.assertEqual(compile_spec(spec).defaults['b'], False)
+
+
+    def test_argfiles(self):
+        spec = """[-c <cal_id>] <file> ...
+        -c <cal_id>     calendar ID
+        -v, --verbose   be verbose
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            lines, nuls = os.path.join(tmp, 'lines'), os.path.join(tmp, 'nuls')
+            with open(lines, 'w') as f:
+                f.write('a b\r\n\n-c\n7\n')
+            with open(nuls, 'wb') as f:
+                f.write(b'x\ny\0' + b'f' * 70000 + b'\0z')
+            opts, args = parse_opts(spec, ['@' + lines, 'k', '-v', '@' + nuls,
+                                           '@'], argfiles=True)
+            self.assertEqual((opts.c, opts['v', 'verbose']), ('7', True))
+            self.assertEqual(args, ['a b', 'k', 'x\ny', 'f' * 70000, 'z', '@'])
+            opts, args = parse_opts(spec, ['@' + lines])
+            self.assertEqual(args, ['@' + lines])
+            opts, args = get_opts('c:', ['-v', '@' + lines], greedy=False,
+                                  panic=False, argfiles=True)
+            self.assertEqual((opts, args), ({'c': None}, []))
+            err = io.StringIO()
+            with redirect_stderr(err), self.assertRaises(SystemExit):
+                get_opts('c:', ['@' + tmp + '/missing'], argfiles=True)
+            self.assertIn('No such file', err.getvalue())
+            from a4.app import AppBase, Runnable
+            got = []
+            @Runnable
+            class MyApp(AppBase):
+                _argfiles = True
+                def argfiles(self, args):
+                    "List arguments."
+                    got.extend(args)
+            with open(lines, 'w') as f:
+                f.write('argfiles\nk\n')
+            argv = sys.argv
+            try:
+                sys.argv = ['x', '@' + lines, 'l']
+                with self.assertRaises(SystemExit) as cm:
+                    MyApp().run()
+                self.assertEqual((cm.exception.code, got), (0, ['k', 'l']))
+            finally:
+                sys.argv = argv
+
+    def test_getopt(self):
+        # same as getopt, in linear time
+        import getopt
+        from a4 import _getopt, _OptError
+        cases = [['-a', 'x', '-bv', '--al', 'y', '--', '-c'],
+                 ['--beta', '3', '-b', '-', 'x', '--beta=', '-ab'],
+                 ['x', '-a'], ['--b'], ['--gamma'], ['-b'], ['--alpha=1']]
+        for argv in cases:
+            for greedy, func in ((True, getopt.gnu_getopt),
+                                 (False, getopt.getopt)):
+                try:
+                    exp = func(argv, 'ab:', ['alpha', 'beta=', 'bet'])
+                except getopt.GetoptError as e:
+                    exp = str(e)
+                try:
+                    got = _getopt(argv, 'ab:', ['alpha', 'beta=', 'bet'],
+                                  greedy=greedy)
+                except _OptError as e:
+                    got = str(e)
+                self.assertEqual(exp, got)
+        argv = ['-v', 'f'] * 100000
+        t0 = time.perf_counter()
+        opts, args = get_opts('v', argv)
+        self.assertEqual(len(args), 100000)
+        self.assertLess(time.perf_counter() - t0, 2)
+
+    def test_inputs(self):
+        import bz2, lzma
+        from a4.inputs import lines
+        text = b'first\n\n' + b'x' * 50 + b'\nlast'
+        want = [b'first', b'', b'x' * 50, b'last']
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name, opener in [('plain', open), ('a.gz', gzip.open),
+                                 ('b.bz2', bz2.open), ('c', lzma.open)]:
+                paths.append(os.path.join(tmp, name))
+                with opener(paths[-1], 'wb') as f:
+                    f.write(text)
+            empty = os.path.join(tmp, 'empty')
+            open(empty, 'wb').close()
+            paths.append(empty)
+            for ahead in (0, 1, 3):
+                for size in (7, 1 << 20):
+                    self.assertEqual(list(lines(paths, ahead=ahead,
+                                                size=size)), want * 4)
+            self.assertEqual(list(lines(paths[:1], encoding='utf-8'))[-1],
+                             'last')
+            with open(paths[0], 'wb') as f:
+                f.write(b'a\0b\0')
+            self.assertEqual(list(lines(paths[:1], sep=b'\0', size=3)),
+                             [b'a', b'b'])
+            stdin = sys.stdin
+            try:
+                sys.stdin = io.TextIOWrapper(io.BufferedReader(
+                    io.BytesIO(gzip.compress(b'in\nput\n'))))
+                self.assertEqual(list(lines(['-'])), [b'in', b'put'])
+            finally:
+                sys.stdin = stdin
+            it = lines(paths[1:3] * 10, size=7)
+            self.assertEqual(next(it), b'first')
+            del it
+            with self.assertRaises(FileNotFoundError):
+                list(lines(paths[:1] + [os.path.join(tmp, 'none')]))
+        # size 0, yet not empty
+        if os.path.exists('/proc/self/status'):
+            self.assertIn(b'Name', b'\n'.join(lines(['/proc/self/status'])))
+
+
+class TestCal(unittest.TestCase):
+    def test_calendar(self):
+        from a4.cal import Calendar
+        cal = Calendar.build('2024', ['0101', '0209-17', '20240404-05'])
+        self.assertEqual(cal[0], 20240102)
+        self.assertFalse(cal.is_business_day(20240210))
+        self.assertNotIn(20240404, cal)
+        self.assertEqual(cal.next(20240208), 20240219)
+        self.assertEqual(cal.prev(20240219), 20240208)
+        self.assertEqual(cal.shift(20240210, 0), 20240219)
+        self.assertEqual(cal.shift(20240210, 2), 20240220)
+        self.assertEqual(cal.shift(20240219, -1), 20240208)
+        self.assertEqual(cal.count(20240401, 20240410), 6)
+        self.assertEqual(list(cal.range(20240403, 20240408)),
+                         [20240403, 20240408])
+        with self.assertRaises(IndexError):
+            cal.next(20241231)
+        wrap = Calendar.build('2024', ['1230-0102'])
+        self.assertEqual((wrap[0], wrap[-1]), (20240103, 20241227))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'x.cal')
+            cal.save(path)
+            shared = Calendar.load(path)
+            self.assertEqual(list(shared), list(cal))
+            self.assertEqual(shared.shift(20240210, 2), 20240220)
+
+    def test_rangeset(self):
+        from a4.rangeset import RangeSet
+        ids = RangeSet.parse('1-9,20-25,10,30-3')
+        self.assertEqual(list(ids.intervals()), [(1, 10), (20, 25), (30, 33)])
+        self.assertEqual(len(ids), 20)
+        self.assertIn(25, ids)
+        self.assertNotIn(11, ids)
+        other = RangeSet.parse('5-21')
+        self.assertEqual(ids | other, RangeSet([(1, 25), (30, 33)]))
+        self.assertEqual(list(ids & other), [5, 6, 7, 8, 9, 10, 20, 21])
+        self.assertEqual(len(RangeSet.parse('1-1000000000')), 1000000000)
+        days = RangeSet.parse('20240125-0205,202402', dates=True)
+        self.assertEqual(list(days.intervals()), [(20240125, 20240229)])
+        self.assertEqual(len(days), 36)
+        self.assertIn(20240201, days)
+        self.assertNotIn(20240230, days)
+        self.assertEqual(list(days)[6:8], [20240131, 20240201])
+        with self.assertRaises(ValueError):
+            ids | days
+
+
+class TestPool(unittest.TestCase):
+    def test_registry(self):
+        import sqlite3
+        from a4.pool import Registry, close_all
+        made = []
+        def factory(dsn):
+            made.append(dsn)
+            return sqlite3.connect(':memory:', check_same_thread=False)
+        def check(conn):
+            return conn.execute('select 1').fetchone() == (1,)
+        reg = Registry(factory, size=2, check=check)
+        url = 'user:p@ss@quickdb/quick?p=v'
+        self.assertIs(reg.pool(url), reg.pool('user:p@ss@quickdb/quick?p=v'))
+        with reg.connection(url) as a:
+            a.execute('create table t (x)')
+        with reg.connection(url) as b:
+            self.assertIs(a, b)
+            with reg.connection(url):
+                with self.assertRaises(TimeoutError):
+                    reg.pool(url).get(timeout=0.01)
+        self.assertEqual(len(made), 2)
+        self.assertEqual(made[0]['host'], 'quickdb')
+        self.assertEqual(made[0]['pass'], 'p@ss')
+        # unhashable defaults
+        other = reg.pool('otherdb', path=['x'], param={'a': '1'})
+        self.assertIs(other, reg.pool('otherdb', path=['x'], param={'a': '1'}))
+        self.assertEqual(other.dsn['path'], ['x'])
+
+        a.close()  # fails the health check, so is replaced
+        with reg.connection(url) as c:
+            self.assertIsNot(c, a)
+        reg.pool(url).idle = 0
+        with reg.connection(url) as d:
+            self.assertIsNot(d, c)
+        close_all()
+        self.assertEqual(reg.pools, {})
+
+
+class TestApp(unittest.TestCase):
+    def test_startup(self):
+        # heavy modules must only be imported when used
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE='')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        cmd = [sys.executable, '-X', 'importtime', '-c', 'import a4.app']
+        subprocess.run(cmd, cwd=root, env=env, check=True,    # warm up .pyc
+                       capture_output=True)
+        res = subprocess.run(cmd, cwd=root, env=env, check=True,
+                             capture_output=True, text=True)
+        times = {}
+        for line in res.stderr.splitlines()[1:]:
+            _, cumulative, name = line.split('|')
+            times[name.strip()] = int(cumulative)
+        for mod in ['re', 'getopt', 'calendar', 'datetime', 'inspect',
+                    'traceback', 'queue', 'pickle', 'multiprocessing']:
+            self.assertNotIn(mod, times)
+        self.assertLess(times['a4.app'], 100000)  # us
+
+    def test_lazy(self):
+        from a4.app import AppBase, Runnable, lazy
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'a4_test_heavy.py'), 'w') as f:
+                f.write('def crunch(app, args):\n'
+                        '    app.crunched = args\n'
+                        'def main(app, args):\n'
+                        '    app._die_usage()\n')
+            sys.path.insert(0, tmp)
+            try:
+                @Runnable
+                class MyApp(AppBase):
+                    crunch = lazy('a4_test_heavy', '''<n>
+                    Crunch numbers.
+                    ''')
+                    squash = lazy('a4_test_heavy:main', '''<n>
+                    Squash numbers.
+                    ''')
+                    def _finally(self):
+                        self.__class__.result = getattr(self, 'crunched',
+                                                        None)
+                app = MyApp()
+                self.assertEqual(app.cmds, ['crunch', 'squash'])
+                self.assertIn('Crunch numbers.', app.getdoc('crunch'))
+                self.assertNotIn('a4_test_heavy', sys.modules)
+                argv, sys.argv = sys.argv, ['x', 'crunch', '42']
+                try:
+                    with self.assertRaises(SystemExit) as cm:
+                        app.run()
+                finally:
+                    sys.argv = argv
+                self.assertEqual(cm.exception.code, 0)
+                self.assertEqual(app.app.result, ['42'])
+                out = io.StringIO()
+                argv, sys.argv = sys.argv, ['x', 'squash']
+                try:
+                    with redirect_stdout(out), self.assertRaises(SystemExit):
+                        MyApp().run()
+                finally:
+                    sys.argv = argv
+                self.assertEqual(out.getvalue(), 'Usage: x squash <n>\n')
+            finally:
+                sys.path.remove(tmp)
+                sys.modules.pop('a4_test_heavy', None)
+
+
+    def test_daily(self):
+        from a4.app import AppBase, Runnable, daily
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, 'out')
+            @Runnable
+            class MyApp(AppBase):
+                def _init(self):
+                    self.pid = os.getpid()
+                def load(self, day, args):
+                    """<yyyymmdd[-mmdd]> [args ...]
+                    Load days.
+                    """
+                    with open(out, 'a') as f:
+                        f.write(f'{day} {self.pid == os.getpid()} {self.dry}'
+                                f' {args}\n')
+                    if day == 20240229:
+                        self._warn('leap day')
+                load = daily(load)
+                def jobs(self, args):
+                    "List jobs."
+                    with open(out, 'w') as f:
+                        f.write('jobs')
+            argv = sys.argv
+            try:
+                for jobs in ('1', '3'):
+                    sys.argv = ['x', '-n', '-j', jobs, 'load', '20240227-0302',
+                                'a']
+                    with redirect_stdout(io.StringIO()):
+                        with self.assertRaises(SystemExit) as cm:
+                            MyApp().run()
+                    self.assertEqual(cm.exception.code, 1)
+                    with open(out) as f:
+                        lines = sorted(f)
+                    os.remove(out)
+                    self.assertEqual(lines, [f"{d} True True ['a']\n" for d in
+                                             (20240227, 20240228, 20240229,
+                                              20240301, 20240302)])
+                # framework state leaves the names of sub-commands alone
+                sys.argv = ['x', '-j', '2', 'jobs']
+                with self.assertRaises(SystemExit) as cm:
+                    MyApp().run()
+                self.assertEqual(cm.exception.code, 0)
+                with open(out) as f:
+                    self.assertEqual(f.read(), 'jobs')
+            finally:
+                sys.argv = argv
+
+    def test_profile(self):
+        from a4.app import AppBase, Runnable
+        @Runnable
+        class MyApp(AppBase):
+            def _init(self):
+                self.data = list(range(1000))
+            def work(self, args):
+                """
+                Work.
+                """
+                sum(self.data)
+            def boom(self, args):
+                raise ValueError('boom')
+        @Runnable
+        class BadApp(AppBase):
+            def _init(self):
+                raise ValueError('no data')
+            def work(self, args):
+                ran.append(args)
+        argv = sys.argv
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                for mode in ('cpu:3', 'mem', 'sample',
+                             f'cpu:{tmp}/out.pstats'):
+                    sys.argv = ['x', '-P', mode, 'work']
+                    err = io.StringIO()
+                    with redirect_stderr(err):
+                        with self.assertRaises(SystemExit) as cm:
+                            MyApp().run()
+                    self.assertEqual(cm.exception.code, 0)
+                    self.assertRegex(err.getvalue(),
+                                     r'(?s)==== _init: .*==== work: ')
+                self.assertEqual(sorted(os.listdir(tmp)),
+                                 ['out.init.pstats', 'out.work.pstats'])
+                # errors are reported as without profiling
+                for mode in ('cpu', 'mem', 'sample', f'cpu:{tmp}/x.pstats'):
+                    sys.argv = ['x', '-P', mode, 'boom']
+                    err = io.StringIO()
+                    with redirect_stderr(err):
+                        with self.assertRaises(SystemExit) as cm:
+                            MyApp().run()
+                    self.assertEqual(cm.exception.code, 2)
+                    self.assertIn('ValueError: boom', err.getvalue())
+                    sys.argv = ['x', '-P', mode, 'work']
+                    ran = []
+                    with redirect_stderr(io.StringIO()):
+                        with self.assertRaises(ValueError):
+                            BadApp().run()
+                    self.assertEqual(ran, [])
+            sys.argv = ['x', '-P', 'bad', 'work']
+            with redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit) as cm:
+                    MyApp().run()
+            self.assertEqual(cm.exception.code, 2)
+        finally:
+            sys.argv = argv
+
+    def test_metrics(self):
+        import json
+        from a4.app import AppBase, Runnable, daily
+        @Runnable
+        class MyApp(AppBase):
+            def _init(self):
+                self.rows = self._counter('rows')
+                self.secs = self._histogram('secs', (0.1, 1))
+            def load(self, day, args):
+                """<yyyymmdd[-mmdd]>
+                Load days.
+                """
+                self.rows.inc(day % 100)
+                self.secs.observe(day % 100 / 2)
+                self._gauge('last').set(day)
+            load = daily(load)
+            def metrics(self, args):
+                "Count a row."
+                self.rows.inc()
+        argv = sys.argv
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'metrics.json')
+                for jobs in ('1', '2'):
+                    sys.argv = ['x', '-j', jobs, '-M', path, 'load',
+                                '20240101-04']
+                    with self.assertRaises(SystemExit) as cm:
+                        MyApp().run()
+                    self.assertEqual(cm.exception.code, 0)
+                    with open(path) as f:
+                        res = json.load(f)
+                    self.assertEqual(res['command'], 'load')
+                    m = res['metrics']
+                    self.assertEqual(m['rows'], 10)
+                    self.assertEqual(m['secs']['count'], 4)
+                    self.assertEqual(m['secs']['buckets'], [[1, 2], ['inf', 2]])
+                    self.assertEqual(m['secs']['p50'], 1)
+                    self.assertEqual(m['secs']['max'], 2)
+                    self.assertIn(m['last'], (20240103, 20240104))
+            sys.argv = ['x', 'load', '20240105']
+            out = io.StringIO()
+            with redirect_stdout(out), self.assertRaises(SystemExit):
+                MyApp().run()
+            self.assertIn('NOTE rows = 5\n', out.getvalue())
+            self.assertIn('NOTE secs: n=1 mean=2.5', out.getvalue())
+            sys.argv = ['x', 'metrics']
+            out = io.StringIO()
+            with redirect_stdout(out), self.assertRaises(SystemExit) as cm:
+                MyApp().run()
+            self.assertEqual(cm.exception.code, 0)
+            self.assertIn('NOTE rows = 1\n', out.getvalue())
+        finally:
+            sys.argv = argv
+
+    def test_cache(self):
+        from a4.app import AppBase, Runnable, daily
+        with tempfile.TemporaryDirectory() as tmp:
+            calls = []
+            @Runnable
+            class MyApp(AppBase):
+                _cache_dir = tmp
+                @daily.cached(key=lambda app, args: args[:1])
+                def load(self, day, args):
+                    """<yyyymmdd[-mmdd]> <table> [<output>]
+                    Load days of a table.
+                    """
+                    calls.append(day)
+                    if day == 20240104 and args[0] == 'fail':
+                        raise ValueError('no data')
+                    return day % 100
+                def cache(self, args):
+                    "Count days of table q not cached."
+                    print(len(self._cache().missing('load', [20240101],
+                                                    ['q'])))
+            def run(*argv):
+                del calls[:]
+                out = io.StringIO()
+                sys.argv = ['x', *argv]
+                with redirect_stdout(out), redirect_stderr(io.StringIO()):
+                    with self.assertRaises(SystemExit) as cm:
+                        MyApp().run()
+                return cm.exception.code, out.getvalue()
+            argv = sys.argv
+            try:
+                self.assertEqual(run('load', '20240101-03', 'q', 'a')[0], 0)
+                self.assertEqual(calls, [20240101, 20240102, 20240103])
+                # framework state leaves the names of sub-commands alone
+                self.assertEqual(run('cache'), (0, '0\n'))
+                # output path is not part of the key
+                run('load', '20240101-05', 'q', 'b')
+                self.assertEqual(calls, [20240104, 20240105])
+                code, out = run('-n', 'load', '20240101-07,20240110', 'q')
+                self.assertEqual(calls, [])
+                self.assertIn('load: would compute 3 of 8 days: '
+                              '20240106-20240107,20240110', out)
+                self.assertEqual(run('load', '20240103-05', 'fail')[0], 2)
+                self.assertEqual(calls, [20240103, 20240104])
+                self.assertEqual(run('-j', '2', 'load', '20240101-06',
+                                     'fail')[0], 2)
+                cache = MyApp().app._cache()
+                self.assertEqual(cache.missing('load', range(20240101,
+                                                             20240107),
+                                               ['fail']), [20240104])
+                self.assertEqual(cache.get('load', 20240105, ['q']), 5)
+                self.assertEqual(cache.missing('load', [20240105, 20240108],
+                                               ['q']), [20240108])
+                cache.max_size = 0
+                cache.evict()
+                self.assertEqual(cache.missing('load', [20240105], ['q']),
+                                 [20240105])
+            finally:
+                sys.argv = argv
+
+    def test_async(self):
+        import asyncio
+        from a4.app import AppBase, Runnable
+        done = []
+        @Runnable
+        class MyApp(AppBase):
+            async def _init(self):
+                self.loops = [asyncio.get_running_loop()]
+                self.busy = self.most = 0
+            async def fetch(self, i):
+                self.busy += 1
+                self.most = max(self.most, self.busy)
+                await asyncio.sleep(0.001)
+                self.busy -= 1
+                return i * i
+            async def fetch_all(self, args):
+                """<n>
+                Fetch n items.
+                """
+                self.loops.append(asyncio.get_running_loop())
+                self.background = log._queue is not None
+                self.got = await self._gather(
+                    (self.fetch(i) for i in range(int(args[0]))), limit=3)
+                log.info('fetched %d', len(self.got))
+                if args[1:] == ['fail']:
+                    raise ValueError('boom')
+            def _finally(self):
+                done.append(self)
+            async def _cleanup(self):
+                self.loops.append(asyncio.get_running_loop())
+        argv = sys.argv
+        try:
+            for fail, code in (([], 0), (['fail'], 2)):
+                sys.argv = ['x', 'fetch_all', '10', *fail]
+                out, err = io.StringIO(), io.StringIO()
+                with redirect_stdout(out), redirect_stderr(err):
+                    with self.assertRaises(SystemExit) as cm:
+                        MyApp().run()
+                self.assertEqual(cm.exception.code, code)
+                app = done.pop()
+                self.assertEqual(app.got, [i * i for i in range(10)])
+                self.assertEqual(app.most, 3)
+                self.assertEqual(len(set(app.loops)), 1)
+                self.assertEqual(len(app.loops), 3)
+                self.assertTrue(app.background)
+                self.assertIsNone(log._queue)
+                self.assertIn('INFO fetched 10', out.getvalue())
+                self.assertEqual('ValueError: boom' in err.getvalue(),
+                                 bool(fail))
+        finally:
+            sys.argv = argv
+
+    def test_trace(self):
+        import json
+        import threading
+        import a4.trace as trace
+        from a4.app import AppBase, Runnable
+        @Runnable
+        class MyApp(AppBase):
+            def _init(self):
+                pass
+            @AppBase._span('transform')
+            def transform(self):
+                with self._span('inner'):
+                    pass
+            def etl(self, args):
+                """
+                Load, transform, write.
+                """
+                with self._span('load'):
+                    worker = threading.Thread(target=self.transform,
+                                              name='transformer')
+                    worker.start()
+                    worker.join()
+                self.transform()
+        self.assertIs(trace.span('x'), trace.span('x'))   # off, no cost
+        argv = sys.argv
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'trace.json')
+                sys.argv = ['x', '-T', path, 'etl']
+                with self.assertRaises(SystemExit) as cm:
+                    MyApp().run()
+                self.assertEqual(cm.exception.code, 0)
+                with open(path) as f:
+                    events = json.load(f)['traceEvents']
+        finally:
+            sys.argv = argv
+        self.assertIsNone(trace._tracer)
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual([e['name'] for e in spans],
+                         ['_init', 'etl', 'load', 'transform', 'inner',
+                          'transform', 'inner'])
+        tids = {e['name']: e['tid'] for e in spans}
+        self.assertNotEqual(tids['load'], spans[3]['tid'])
+        self.assertIn({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                       'tid': threading.get_native_id(),
+                       'args': {'name': 'MainThread'}}, events)
+        etl, load = spans[1], spans[2]
+        self.assertLessEqual(etl['ts'], load['ts'])
+        self.assertGreaterEqual(etl['ts'] + etl['dur'],
+                                load['ts'] + load['dur'])
+        tracer = trace.Tracer(2)
+        for name in 'abc':
+            tracer.add(name, 1, 2)
+        self.assertEqual(tracer.close(), 1)
+
+    def test_ledger(self):
+        import json
+        from a4.app import AppBase, Runnable, GLOBAL_SPEC
+        from a4.ledger import LedgerApp, read, append
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'runs', 'ledger.jsonl')
+            @Runnable
+            class MyApp(AppBase):
+                _ledger = path
+                def work(self, args):
+                    "Write a file."
+                    with open(os.path.join(tmp, 'out'), 'wb') as f:
+                        f.write(bytes(1 << 16))
+                        f.flush()
+                def fail(self, args):
+                    "Fail."
+                    self.excode = 3
+                def ledger(self, args):
+                    "Do nothing."
+            argv = sys.argv
+            try:
+                for cmd in ['work'] * 6 + ['fail']:
+                    sys.argv = ['x', cmd, 'a', 'b']
+                    with self.assertRaises(SystemExit):
+                        MyApp().run()
+            finally:
+                sys.argv = argv
+            recs = list(read(path))
+            self.assertEqual([r['cmd'] for r in recs], ['work'] * 6 + ['fail'])
+            self.assertEqual(recs[0]['app'], 'x')
+            self.assertEqual(recs[0]['args'], 'a b')
+            self.assertEqual([r['code'] for r in recs[-2:]], [0, 3])
+            self.assertGreater(recs[0]['rss'], 0)
+            self.assertGreaterEqual(recs[0]['cpu'], 0)
+            if os.path.exists('/proc/self/io'):
+                self.assertGreaterEqual(recs[0]['io'][1], 1 << 16)
+
+            def ledger(*args):
+                out = io.StringIO()
+                with redirect_stdout(out), \
+                     self.assertRaises(SystemExit) as cm:
+                    LedgerApp().dispatch(get_opts(GLOBAL_SPEC, [])[0],
+                                         list(args))
+                return cm.exception.code, out.getvalue()
+            code, out = ledger('summary', '-f', path)
+            self.assertEqual(code, 0)
+            lines = out.splitlines()
+            self.assertEqual(len(lines), 3)
+            self.assertTrue(lines[1].startswith('x fail '))
+            self.assertEqual(lines[2].split()[2:4], ['6', '0'])
+            # framework state leaves the names of sub-commands alone
+            try:
+                sys.argv = ['x', 'ledger']
+                with self.assertRaises(SystemExit) as cm:
+                    MyApp().run()
+            finally:
+                sys.argv = argv
+            self.assertEqual(cm.exception.code, 0)
+            self.assertEqual(list(read(path))[-1]['cmd'], 'ledger')
+            # runs of steady usage, then a slow one
+            path = os.path.join(tmp, 'steady.jsonl')
+            for wall in (1, 1.2, 0.9, 1.1, 1, 1.15):
+                append(path, dict(recs[0], wall=wall, cpu=0.5, rss=1000))
+            self.assertEqual(ledger('check', '-f', path), (0, ''))
+            with open(path, 'a') as f:
+                f.write('damaged\n')
+            append(path, dict(recs[0], wall=2, cpu=0.5, rss=1000))
+            code, out = ledger('check', '-f', path, 'work')
+            self.assertEqual(code, 1)
+            self.assertIn('WARN x work at', out)
+            self.assertIn('wall ', out)
+            self.assertNotIn('cpu ', out)
+
+    def test_serve(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'app.py'), 'w') as f:
+                f.write('import os\n'
+                        'from a4.app import AppBase, Runnable\n'
+                        '@Runnable\n'
+                        'class MyApp(AppBase):\n'
+                        '    _serve_workers = 1\n'
+                        '    _serve_requests = 2\n'
+                        '    def _init(self):\n'
+                        '        self.inits = getattr(self, "inits", 0) + 1\n'
+                        '    def pid(self, args):\n'
+                        '        print(os.getpid(), self.inits, args, self.dry)\n'
+                        '    def fail(self, args):\n'
+                        '        raise ValueError("boom")\n'
+                        '    def late(self, args):\n'
+                        '        self.late = True\n'
+                        '    def _finally(self):\n'
+                        '        if self.__dict__.pop("late", False):\n'
+                        '            raise RuntimeError("in _finally")\n'
+                        'MyApp().run()\n')
+            sock = os.path.join(tmp, 'sock')
+            server = subprocess.Popen([sys.executable, 'app.py', '-S', sock],
+                                      cwd=tmp, env=env,
+                                      stdout=subprocess.DEVNULL)
+            def call(*argv):
+                return subprocess.run([sys.executable, '-m', 'a4.client',
+                                       sock, *argv], env=env, timeout=10,
+                                      capture_output=True, text=True)
+            try:
+                for _ in range(100):
+                    if os.path.exists(sock):
+                        break
+                    time.sleep(0.05)
+                first = call('pid', 'a')
+                self.assertEqual(first.returncode, 0)
+                pid, inits, rest = first.stdout.split(' ', 2)
+                self.assertEqual((inits, rest), ('1', "['a'] False\n"))
+                second = call('-n', 'pid', 'b')
+                self.assertEqual(second.stdout.split(' ', 1)[0], pid)
+                self.assertTrue(second.stdout.endswith("['b'] True\n"))
+                res = call('fail')   # recycled worker
+                self.assertEqual(res.returncode, 2)
+                self.assertIn('ValueError: boom', res.stderr)
+                self.assertEqual(call('nope').returncode, 2)
+                self.assertNotEqual(call('pid').stdout.split(' ')[0], pid)
+                # uncaught, as a direct run
+                res = subprocess.run([sys.executable, 'app.py', '-C', sock,
+                                      'late'], cwd=tmp, env=env, timeout=10,
+                                     capture_output=True, text=True)
+                self.assertEqual(res.returncode, 1)
+                self.assertIn('RuntimeError: in _finally', res.stderr)
+                self.assertEqual(call('pid').returncode, 0)
+            finally:
+                server.terminate()
+                self.assertEqual(server.wait(10), 0)
+            self.assertFalse(os.path.exists(sock))
+            # a failing _init stops the server instead of forking forever
+            with open(os.path.join(tmp, 'bad.py'), 'w') as f:
+                f.write('from a4.app import AppBase, Runnable\n'
+                        '@Runnable\n'
+                        'class MyApp(AppBase):\n'
+                        '    def _init(self):\n'
+                        '        raise ValueError("no db")\n'
+                        '    def pid(self, args):\n'
+                        '        pass\n'
+                        'MyApp().run()\n')
+            res = subprocess.run([sys.executable, 'bad.py', '-S', sock],
+                                 cwd=tmp, env=env, timeout=10,
+                                 capture_output=True, text=True)
+            self.assertEqual(res.returncode, 2)
+            self.assertLessEqual(res.stderr.count('ValueError: no db'), 4)
+            self.assertIn('worker failed to initialize', res.stdout)
+            self.assertFalse(os.path.exists(sock))
+
+    @unittest.skipUnless(os.path.exists('/bin/bash'), 'no bash')
+    def test_complete(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, PYTHONPATH=root, XDG_CACHE_HOME=tmp)
+            with open(os.path.join(tmp, 'app.py'), 'w') as f:
+                f.write('from a4.app import AppBase, Runnable\n'
+                        '@Runnable\n'
+                        'class MyApp(AppBase):\n'
+                        '    def load(self, args):\n'
+                        '        """[-c <cal_id>] <file>\n'
+                        '        Load\tquotes.\n'
+                        '        -c <cal_id>     calendar ID\n'
+                        '        -o, --output <file>   output file\n'
+                        '        """\n'
+                        '    def list(self, args):\n'
+                        '        pass\n'
+                        'MyApp().run()\n')
+            script = subprocess.run([sys.executable, 'app.py', 'help',
+                                     '--bash', 'myapp'], cwd=tmp, env=env,
+                                    check=True, capture_output=True,
+                                    text=True).stdout
+            index = os.path.join(tmp, 'a4', 'complete', 'myapp.idx')
+            with open(index) as f:
+                self.assertEqual(f.read(),
+                                 'list\t\t<no documentation>\n'
+                                 'load\t-c -o --output\tLoad quotes.\n')
+            self.assertIn('#compdef myapp', subprocess.run(
+                [sys.executable, 'app.py', 'help', '--zsh', 'myapp'],
+                cwd=tmp, env=env, capture_output=True, text=True).stdout)
+            os.utime(index, (0, 0))
+            test = script + '''
+                c() {
+                    COMP_WORDS=("$@"); COMP_CWORD=$(($# - 1)); COMPREPLY=()
+                    _a4_myapp
+                    echo "$?:${COMPREPLY[*]}"
+                }
+                c myapp ''; c myapp l; c myapp -; c myapp -v -j 2 load -
+                c myapp help ''; c myapp load x
+            '''
+            out = subprocess.run(['bash', '-c', test], cwd=root, timeout=30,
+                                 check=True, capture_output=True,
+                                 text=True).stdout
+            self.assertEqual(out.splitlines(), [
+                '0:list load help', '0:list load',
+                '0:-n -v -V -j -P -M -T -S -C', '0:-c -o --output',
+                '0:list load', '1:'])
+            # regenerated once, stale as the module was newer
+            self.assertGreater(os.stat(index).st_mtime, 0)
+
+
+class TestBench(unittest.TestCase):
+    def test_compare(self):
+        import bench
+        calls = []
+        self.assertGreater(bench.ops_per_sec(lambda: calls.append(1),
+                                             secs=0.01, rounds=1), 0)
+        peak, kept = bench.allocations(lambda: calls.append(1), n=100)
+        self.assertGreater(kept, 0)
+        res = {'a': {'ops': 75}, 'b': {'ops': 90}, 'c': {'ops': 1}}
+        base = {'a': {'ops': 100}, 'b': {'ops': 100}}
+        self.assertEqual(bench.compare(res, base, 0.2), [('a', -0.25)])
+
+
+class TestLog(unittest.TestCase):
+    def tearDown(self):
+        log.stop()
+
+    def test_emitters(self):
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            log.level('w')
+            self.assertIs(log._info, log._noop)
+            log.info('hidden')
+            from a4.log import dbg
+            dbg('hidden')
+            log.level('d')
+            dbg('imported')
+            log.level('w')
+            log.warn('shown')
+            log.fork = True
+            log.err('forked')
+            log.fork = False
+            log.level('i')
+        self.assertRegex(out.getvalue(),
+                         r'^\[[-\d :.]+\] DBG  imported\n'
+                         r'\[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{3}\] WARN shown\n$')
+        self.assertIn('ERR  forked', err.getvalue())
+
+    def test_lazy(self):
+        calls = []
+        def render():
+            calls.append(1)
+            return 'rendered'
+        out = io.StringIO()
+        with redirect_stdout(out):
+            log.level('i')
+            self.assertFalse(log.enabled('d'))
+            self.assertTrue(log.enabled(log.WARN))
+            log.dbg(render)
+            log.dbg('%s %d', object(), 1)
+            log.info(render)
+            log.info('%s=%d', 'x', 42)
+        self.assertEqual(len(calls), 1)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].endswith('INFO rendered'))
+        self.assertTrue(lines[1].endswith('INFO x=42'))
+
+    def test_ts(self):
+        t = 1600000000.25
+        self.assertEqual(log._ts(t), str(dt.datetime.fromtimestamp(t))[:-3])
+        self.assertEqual(log._ts(t + 0.0001), log._ts(t))
+        self.assertEqual(log._ts(t + 1.5)[:-4],
+                         str(dt.datetime.fromtimestamp(t + 1.5))[:-7])
+
+    def test_binary(self):
+        from a4 import binlog
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'x.blog')
+            pid = os.fork()
+            if pid == 0:
+                # crash without flushing or closing
+                log.binary(path, slots=4, slot_size=48)
+                for i in range(10):
+                    log.warn('item %d %s', i, 'abc')
+                    log.info(f'one-off {i}')
+                log.err(lambda: 'lazy')
+                os._exit(1)
+            os.waitpid(pid, 0)
+            recs = list(binlog.read(path))
+            self.assertEqual([m for _, _, m in recs],
+                             ['one-off 8', 'item 9 abc', 'one-off 9', 'lazy'])
+            self.assertEqual(recs[-1][1], log.ERROR)
+            self.assertEqual(len(list(binlog.read(path, 2))), 2)
+            with open(path, 'rb') as f:
+                buf = f.read()
+            head = binlog._HEAD.unpack_from(buf)
+            self.assertEqual(binlog._strings(buf, head), ['item %d %s'])
+            # forked children share the file
+            path = os.path.join(tmp, 'fork.blog')
+            log.binary(path, slots=1024)
+            try:
+                log.warn('parent %d', 0)
+                pids = []
+                for n in range(3):
+                    pid = os.fork()
+                    if pid == 0:
+                        for i in range(100):
+                            log.warn(f'child {n} %d', i)
+                        os._exit(0)
+                    pids.append(pid)
+                log.warn('parent %d', 1)
+                for pid in pids:
+                    os.waitpid(pid, 0)
+            finally:
+                log.binary(None)
+            msgs = [m for _, _, m in binlog.read(path)]
+            self.assertEqual(len(msgs), 302)
+            for n in range(3):
+                mine = [m for m in msgs if m.startswith(f'child {n} ')]
+                self.assertEqual(mine, [f'child {n} {i}' for i in range(100)])
+
+    def test_aggregate(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            log.aggregate(0.2)
+            pids = []
+            for n in range(3):
+                pid = os.fork()
+                if pid == 0:
+                    for i in range(100):
+                        log.warn('worker %d line %d', n, i)
+                    os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                os.waitpid(pid, 0)
+            log.warn('parent')
+            log.aggregate(None)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 301)
+        for line in lines:
+            self.assertRegex(line, r'^\[.{23}\] WARN \[\d+\] '
+                                   r'(parent|worker \d line \d+)$')
+        self.assertTrue(lines[-1].endswith(f'[{os.getpid()}] parent'))
+        stamps = [line[1:24] for line in lines]
+        self.assertEqual(stamps, sorted(stamps))
+
+    def test_limit(self):
+        from a4.app import AppBase
+        app = AppBase()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            log.limit(rate=0.001, burst=3)
+            for i in range(5):
+                log.info('same')
+            log.info('other')
+            for i in range(10):
+                app._warn('flapping %d', i)
+            log.limit(None)
+        self.assertEqual(app.excode, 1)
+        msgs = [line[26:] for line in out.getvalue().splitlines()]
+        self.assertEqual(msgs, ['INFO same',
+                                'INFO last message repeated 4 times',
+                                'INFO other',
+                                'WARN flapping 0',
+                                'WARN flapping 1',
+                                'WARN flapping 2',
+                                'WARN suppressed 7 records of flapping %d'])
+        out = io.StringIO()
+        with redirect_stdout(out):
+            log.limit(rate=0.001, burst=1, site=True, collapse=False)
+            for i in range(3):
+                app._warn('site a %d', i)
+                app._warn('site b %d', i)
+            log.warn({'a': 1})
+            log.limit(None)
+        msgs = [line[26:] for line in out.getvalue().splitlines()]
+        self.assertEqual(msgs[:3], ['WARN site a 0', 'WARN site b 0',
+                                    "WARN {'a': 1}"])
+        self.assertEqual(len(msgs), 5)
+        self.assertTrue(all(__file__ in m for m in msgs[3:]))
+        with redirect_stdout(io.StringIO()):
+            log.limit(rate=0.001, burst=1)
+            log.warn({'a': 1})
+            log.warn(['b'])
+            log.limit(None)
+        # repeats of a suppressed record are suppressed, not repeats
+        out = io.StringIO()
+        with redirect_stdout(out):
+            log.limit(rate=0.0001, burst=1)
+            log.warn('a %d', 1)
+            for i in range(3):
+                log.warn('a %d', 2)
+            log.limit(None)
+        msgs = [line[26:] for line in out.getvalue().splitlines()]
+        self.assertEqual(msgs, ['WARN a 1',
+                                'WARN suppressed 3 records of a %d'])
+
+    def test_to_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'x.log')
+            log.fork = True
+            log.to_file(path, size=100)
+            for i in range(10):
+                log.warn('line %d of a rotated log', i)
+            log.to_file(None)
+            log.fork = False
+            names = sorted(os.listdir(tmp))
+            today = parse_date('today', to_str=True)
+            self.assertEqual(names[0], 'x.log')
+            self.assertIn(f'x.log.{today}.gz', names)
+            self.assertIn(f'x.log.{today}.1.gz', names)
+            self.assertTrue(all(n.endswith('.gz') for n in names[1:]))
+            text = ''
+            for name in names[1:]:
+                with gzip.open(os.path.join(tmp, name), 'rt') as f:
+                    text += f.read()
+            with open(path) as f:
+                text += f.read()
+            self.assertNotIn('\033', text)
+            self.assertEqual(len(text.splitlines()), 10)
+            # buffered lines are written once, not again by forked children
+            path = os.path.join(tmp, 'fork.log')
+            log.to_file(path)
+            log.info('parent')
+            pids = []
+            for n in range(3):
+                pid = os.fork()
+                if pid == 0:
+                    log.info('child %d', n)
+                    log.flush()
+                    os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                os.waitpid(pid, 0)
+            log.to_file(None)
+            with open(path) as f:
+                msgs = sorted(line[26:] for line in f)
+            self.assertEqual(msgs, ['INFO child 0\n', 'INFO child 1\n',
+                                    'INFO child 2\n', 'INFO parent\n'])
+
+    def test_background(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            log.background(16)
+            for i in range(1000):
+                log.warn(f'line {i}')
+            log.flush()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1000)
+        self.assertTrue(lines[-1].endswith('WARN line 999'))
+
+    def test_background_drop(self):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            log.background(1, policy='count')
+            for i in range(1000):
+                log.warn(f'line {i}')
+            log.stop()
+        lines = out.getvalue().splitlines()
+        if len(lines) < 1000:
+            mo = re.search(r'WARN (\d+) log records dropped$', lines[-1])
+            self.assertEqual(len(lines) - 1 + int(mo.group(1)), 1000)
+        with self.assertRaises(ValueError):
+            log.background(policy='junk')
+
 if __name__ == '__main__':
     unittest.main()